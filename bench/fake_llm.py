@@ -0,0 +1,97 @@
+"""
+Fake OpenAI-compatible chat completions server for benchmarks.
+
+Prefill is simulated from the prompt size: TTFT = --ttft + uncached prompt chars / --prefill-cps.
+Prompts that extend an earlier prompt only pay for the new suffix (prefix caching, as in
+vLLM / llama.cpp). Tokens then stream at --tps up to --tokens (or the request's max_tokens).
+GET /stats returns request and prefill counters.
+"""
+import argparse, json, threading, time
+from collections import OrderedDict
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+
+CONFIG = {"ttft": 0.3, "prefill_cps": 200000.0, "tps": 50.0, "tokens": 200}
+STATS = {"requests": 0, "streamed": 0, "prompt_chars": 0, "cached_chars": 0, "completion_tokens": 0}
+_prefixes: "OrderedDict[str, None]" = OrderedDict()  # recent prompts, most recent last
+_lock = threading.Lock()
+
+
+def _prompt_text(body):
+    messages = body.get("messages") or []
+    return "".join(m.get("content") or "" for m in messages if isinstance(m, dict))
+
+
+def _prefill(text):
+    """Sleep for the simulated prefill of text; returns (prompt chars, cached chars)."""
+    with _lock:
+        cached = max((len(p) for p in _prefixes if text.startswith(p)), default=0)
+        _prefixes[text] = None
+        _prefixes.move_to_end(text)
+        while len(_prefixes) > 256:
+            _prefixes.popitem(last=False)
+        STATS["requests"] += 1
+        STATS["prompt_chars"] += len(text)
+        STATS["cached_chars"] += cached
+    time.sleep(CONFIG["ttft"] + (len(text) - cached) / CONFIG["prefill_cps"])
+    return len(text), cached
+
+
+def _tokens(n):
+    return [f"tok{i} " if i % 12 else f"\n### Section {i // 12}\n" for i in range(n)]
+
+
+@app.post("/v1/chat/completions")
+def chat_completions():
+    body = request.get_json(silent=True) or {}
+    n = min(int(body.get("max_tokens") or CONFIG["tokens"]), CONFIG["tokens"])
+    model = body.get("model") or "bench"
+    text = _prompt_text(body)
+
+    if not body.get("stream"):
+        _prefill(text)
+        time.sleep(n / CONFIG["tps"])
+        with _lock:
+            STATS["completion_tokens"] += n
+        return jsonify({"id": "bench", "object": "chat.completion", "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(_tokens(n))},
+                                     "finish_reason": "stop"}]})
+
+    def stream():
+        _prefill(text)
+        with _lock:
+            STATS["streamed"] += 1
+        for piece in _tokens(n):
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            with _lock:
+                STATS["completion_tokens"] += 1
+            time.sleep(1 / CONFIG["tps"])
+        yield "data: [DONE]\n\n"
+
+    return Response(stream(), mimetype="text/event-stream")
+
+
+@app.get("/stats")
+def stats():
+    with _lock:
+        return jsonify(dict(STATS))
+
+
+@app.get("/healthz")
+def healthz():
+    return "ok", 200
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--ttft", type=float, default=CONFIG["ttft"], help="fixed time to first token (s)")
+    parser.add_argument("--prefill-cps", type=float, default=CONFIG["prefill_cps"], help="prefill speed (prompt chars/s)")
+    parser.add_argument("--tps", type=float, default=CONFIG["tps"], help="generation speed (tokens/s)")
+    parser.add_argument("--tokens", type=int, default=CONFIG["tokens"], help="tokens per completion")
+    args = parser.parse_args()
+    CONFIG.update(ttft=args.ttft, prefill_cps=args.prefill_cps, tps=args.tps, tokens=args.tokens)
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
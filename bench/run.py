@@ -0,0 +1,341 @@
+"""
+End-to-end benchmark: webserver -> agents -> llm, with local stand-ins for everything external.
+
+    python bench/run.py [--kinds code,container,k8s] [--requests 12] [--concurrency 4] ... --out new.json
+    python bench/run.py --compare old.json new.json
+
+Starts the fake LLM (fake_llm.py), the llm service, the three scan agents and the webserver
+from this checkout on their usual ports (5000-5002, 5010, 5080; the fake LLM on --llm-port).
+Scanners are stub_tool.py symlinks on PATH, and https://github.com/bench/<repo> is
+redirected to synthetic git repos on disk via git url.insteadOf, so nothing leaves the host.
+
+Each request is one /scan/<kind>/stream call. Stages come from its SSE events:
+scan (request -> "... completed" status), llm_wait (scan done -> first token),
+first_token (request -> first token), generation (first -> last token), total.
+The JSON report has p50/p95/mean/max per stage, throughput and per-service peak memory.
+"""
+import argparse, json, os, shutil, signal, statistics, subprocess, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH = Path(__file__).resolve().parent
+TOOLS = ["gitleaks", "semgrep", "bandit", "trivy", "kube-linter", "opa", "helm", "kustomize"]
+WEB_URL = "http://127.0.0.1:5080"
+STAGES = ["scan", "llm_wait", "first_token", "generation", "total"]
+
+
+def _git(repo, *args):
+    subprocess.run(["git", "-C", str(repo), "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_repo(path: Path, files: int) -> None:
+    """Synthetic repo: python modules, Dockerfiles, plain manifests, a Helm chart and a Kustomize overlay."""
+    for i in range(files):
+        mod = path / "src" / f"pkg{i % 10}" / f"mod{i}.py"
+        mod.parent.mkdir(parents=True, exist_ok=True)
+        mod.write_text("import subprocess\n\n" + "".join(
+            f"def handler_{j}(cmd):\n    return subprocess.call(cmd, shell=True)\n\n" for j in range(20)))
+    (path / "requirements.txt").write_text("flask==2.0.0\nrequests==2.19.0\n")
+    (path / "Dockerfile").write_text("ARG PY=3.12\nFROM python:${PY}-slim AS build\nFROM nginx:1.27\n")
+    (path / "worker.Dockerfile").write_text("FROM python:3.12-slim\n")
+    for i in range(max(1, files // 20)):
+        m = path / "deploy" / f"app{i}.yaml"
+        m.parent.mkdir(parents=True, exist_ok=True)
+        m.write_text(f"apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: app{i}\nspec:\n  replicas: 1\n---\n"
+                     f"apiVersion: v1\nkind: Service\nmetadata:\n  name: app{i}\n")
+    (path / ".github" / "workflows").mkdir(parents=True, exist_ok=True)
+    (path / ".github" / "workflows" / "ci.yml").write_text("on: push\njobs:\n  test:\n    runs-on: ubuntu-latest\n")
+    (path / "chart" / "templates").mkdir(parents=True, exist_ok=True)
+    (path / "chart" / "Chart.yaml").write_text("apiVersion: v2\nname: chart\nversion: 0.1.0\n")
+    (path / "chart" / "templates" / "deployment.yaml").write_text("apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: {{ .Release.Name }}\n")
+    for d in ("base", "overlays/prod"):
+        (path / "kustomize" / d).mkdir(parents=True, exist_ok=True)
+    (path / "kustomize" / "base" / "kustomization.yaml").write_text("resources:\n- cm.yaml\n")
+    (path / "kustomize" / "base" / "cm.yaml").write_text("apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: cm\n")
+    (path / "kustomize" / "overlays" / "prod" / "kustomization.yaml").write_text("resources:\n- ../../base\nnamePrefix: prod-\n")
+    _git(path, "init", "-q", "-b", "main")
+    _git(path, "add", "-A")
+    _git(path, "commit", "-q", "-m", "bench fixture")
+
+
+# ---- Services ----
+def _tree_rss_kb(pid: int) -> int:
+    """Resident memory of pid and all its descendants (scanner subprocesses included)."""
+    children = {}
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat.read_text().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+        except (OSError, IndexError, ValueError):
+            continue
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        todo += children.get(p, [])
+        try:
+            total += int(next(l for l in Path(f"/proc/{p}/status").read_text().splitlines() if l.startswith("VmRSS:")).split()[1])
+        except (OSError, StopIteration, ValueError):
+            continue
+    return total
+
+
+class Services:
+    def __init__(self, workdir: Path, args):
+        self.workdir = workdir
+        self.args = args
+        self.procs = {}
+        self.peak_kb = {}
+        self._stop = threading.Event()
+
+    def env(self) -> dict:
+        bindir = self.workdir / "bin"
+        cache = self.workdir / "cache"
+        env = dict(os.environ)
+        env.update({
+            "PATH": f"{bindir}{os.pathsep}{env.get('PATH', '')}",
+            "PYTHONUNBUFFERED": "1",
+            "PYTHONPATH": str(ROOT / "common"),  # agentlib, copied into the images at build time
+            # https://github.com/bench/<name> -> local fixture repo
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": f"url.{self.workdir / 'repos'}/.insteadOf",
+            "GIT_CONFIG_VALUE_0": "https://github.com/bench/",
+            "REPO_CACHE_DIR": str(cache / "repos"),
+            "IMAGE_CACHE_DIR": str(cache / "images"),
+            "TRIVY_CACHE_DIR": str(cache / "trivy"),
+            "SBOM_DIR": str(cache / "sboms"),
+            "RENDER_CACHE_DIR": str(cache / "render"),
+            "SEMGREP_RULES_DIR": str(cache / "semgrep-rules"),
+            "SEMGREP_REGISTRY_URL": "http://127.0.0.1:9",  # unreachable: no rules download
+            "RESOLVE_DIGESTS": "0",
+            "BENCH_FINDINGS": str(self.args.findings),
+            "BENCH_TOOL_DELAY": str(self.args.tool_delay),
+            "CODE_AGENT_URL": "http://127.0.0.1:5000",
+            "CONTAINER_AGENT_URL": "http://127.0.0.1:5001",
+            "K8S_AGENT_URL": "http://127.0.0.1:5002",
+            "SYSLOG_AGENT_URL": "http://127.0.0.1:5003",
+        })
+        return env
+
+    def start(self) -> None:
+        bindir = self.workdir / "bin"
+        bindir.mkdir(parents=True)
+        for tool in TOOLS:
+            (bindir / tool).symlink_to(BENCH / "stub_tool.py")
+        os.chmod(BENCH / "stub_tool.py", 0o755)
+        (self.workdir / "logs").mkdir()
+
+        a = self.args
+        py = sys.executable
+        specs = {
+            "fake-llm": ([py, str(BENCH / "fake_llm.py"), "--port", str(a.llm_port), "--ttft", str(a.ttft),
+                          "--prefill-cps", str(a.prefill_cps), "--tps", str(a.tps), "--tokens", str(a.tokens)],
+                         BENCH, {}, f"http://127.0.0.1:{a.llm_port}/healthz"),
+            "llm": ([py, "server.py"], ROOT / "llm", {"LLM_URL": f"http://127.0.0.1:{a.llm_port}"}, "http://127.0.0.1:5010/healthz"),
+            "code-agent": ([py, "server.py"], ROOT / "code-agent" / "app", {}, "http://127.0.0.1:5000/healthz"),
+            "container-agent": ([py, "server.py"], ROOT / "container-agent" / "app", {}, "http://127.0.0.1:5001/healthz"),
+            "k8s-agent": ([py, "server.py"], ROOT / "k8s-agent" / "app", {}, "http://127.0.0.1:5002/healthz"),
+            "webserver": ([py, "server.py"], ROOT / "webserver" / "app", {"LLM_URL": "http://127.0.0.1:5010"}, f"{WEB_URL}/healthz"),
+        }
+        base = self.env()
+        for name, (cmd, cwd, extra, _) in specs.items():
+            log = open(self.workdir / "logs" / f"{name}.log", "w")
+            self.procs[name] = subprocess.Popen(cmd, cwd=cwd, env={**base, **extra}, stdout=log, stderr=subprocess.STDOUT,
+                                                start_new_session=True)
+        for name, (_, _, _, health) in specs.items():
+            deadline = time.time() + 60
+            while True:
+                if self.procs[name].poll() is not None:
+                    raise RuntimeError(f"{name} exited, see {self.workdir / 'logs' / (name + '.log')}")
+                try:
+                    if requests.get(health, timeout=2).ok:
+                        break
+                except requests.RequestException:
+                    pass
+                if time.time() > deadline:
+                    raise RuntimeError(f"{name} did not become healthy")
+                time.sleep(0.2)
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(0.25):
+            for name, p in self.procs.items():
+                self.peak_kb[name] = max(self.peak_kb.get(name, 0), _tree_rss_kb(p.pid))
+
+    def memory(self) -> dict:
+        found = {}
+        for name, p in self.procs.items():
+            try:
+                hwm = int(next(l for l in Path(f"/proc/{p.pid}/status").read_text().splitlines()
+                               if l.startswith("VmHWM:")).split()[1])
+            except (OSError, StopIteration, ValueError):
+                hwm = 0
+            found[name] = {"peak_tree_rss_mb": round(self.peak_kb.get(name, 0) / 1024, 1), "hwm_mb": round(hwm / 1024, 1)}
+        return found
+
+    def stop(self) -> None:
+        self._stop.set()
+        for p in self.procs.values():
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for p in self.procs.values():
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+
+
+# ---- Workload ----
+def _iter_sse(response):
+    event_type, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data_lines:
+                yield event_type, "\n".join(data_lines)
+            event_type, data_lines = "message", []
+        elif line.startswith("event:"):
+            event_type = line[6:].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+
+
+def one_request(kind: str, repo: str) -> dict:
+    t0 = time.perf_counter()
+    marks = {}
+    error = None
+    try:
+        with requests.post(f"{WEB_URL}/scan/{kind}/stream", json={"repo": repo}, stream=True, timeout=600) as r:
+            r.raise_for_status()
+            for event, data in _iter_sse(r):
+                now = time.perf_counter() - t0
+                try:
+                    body = json.loads(data)
+                except ValueError:
+                    body = {}
+                if event == "error":
+                    error = body.get("error") or data
+                elif event == "done":
+                    marks["done"] = now
+                elif "delta" in body:
+                    marks.setdefault("first_token", now)
+                elif "completed" in str(body.get("status", "")):
+                    marks.setdefault("scan", now)
+    except requests.RequestException as e:
+        error = str(e)
+    total = time.perf_counter() - t0
+    if error or not {"scan", "first_token", "done"} <= marks.keys():
+        return {"error": error or f"incomplete stream: {sorted(marks)}", "total": total}
+    return {"scan": marks["scan"], "llm_wait": marks["first_token"] - marks["scan"], "first_token": marks["first_token"],
+            "generation": marks["done"] - marks["first_token"], "total": marks["done"]}
+
+
+def _summary(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {"p50": round(statistics.median(values), 4), "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 4),
+            "mean": round(statistics.fmean(values), 4), "max": round(values[-1], 4)}
+
+
+def run_workload(kind: str, repos: list, args) -> dict:
+    for i in range(args.warmup):
+        one_request(kind, repos[i % len(repos)])
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda i: one_request(kind, repos[i % len(repos)]), range(args.requests)))
+    wall = time.perf_counter() - t0
+    ok = [r for r in results if "error" not in r]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_samples": sorted({r["error"] for r in results if "error" in r})[:3],
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 3) if wall else 0,
+        "stages": {stage: _summary([r[stage] for r in ok]) for stage in STAGES},
+    }
+
+
+# ---- Comparison ----
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield from _flatten(v, f"{prefix}{k}.")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix[:-1], value
+
+
+def compare(old_path: str, new_path: str) -> None:
+    old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+    a = dict(_flatten({"workloads": old.get("workloads"), "services": old.get("services")}))
+    b = dict(_flatten({"workloads": new.get("workloads"), "services": new.get("services")}))
+    print(f"{'metric':60} {old.get('label') or 'old':>12} {new.get('label') or 'new':>12} {'change':>9}")
+    for key in sorted(a.keys() & b.keys()):
+        change = f"{(b[key] - a[key]) / a[key] * 100:+.1f}%" if a[key] else ""
+        print(f"{key:60} {a[key]:>12} {b[key]:>12} {change:>9}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end scan + LLM benchmark with local stand-ins")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two reports and exit")
+    parser.add_argument("--kinds", default="code,container,k8s")
+    parser.add_argument("--requests", type=int, default=12, help="measured requests per kind")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured requests per kind (fills repo caches)")
+    parser.add_argument("--repos", type=int, default=2, help="distinct fixture repos")
+    parser.add_argument("--files", type=int, default=200, help="python modules per repo")
+    parser.add_argument("--findings", type=int, default=50, help="findings per stub tool invocation")
+    parser.add_argument("--tool-delay", type=float, default=0.5, help="seconds per stub tool invocation")
+    parser.add_argument("--llm-port", type=int, default=5099)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--prefill-cps", type=float, default=200000.0)
+    parser.add_argument("--tps", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--out", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--keep", action="store_true", help="keep the work dir (repos, caches, service logs)")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    services = Services(workdir, args)
+    try:
+        repos = []
+        for i in range(args.repos):
+            make_repo(workdir / "repos" / f"repo{i}", args.files)
+            repos.append(f"https://github.com/bench/repo{i}")
+        services.start()
+        workloads = {kind: run_workload(kind, repos, args) for kind in args.kinds.split(",") if kind}
+        report = {
+            "label": args.label,
+            "started_at": int(time.time()),
+            "config": {k: v for k, v in vars(args).items() if k not in ("compare", "out", "keep")},
+            "workloads": workloads,
+            "services": services.memory(),
+            "llm_upstream": requests.get(f"http://127.0.0.1:{args.llm_port}/stats", timeout=5).json(),
+        }
+    finally:
+        services.stop()
+        if args.keep:
+            print(f"work dir kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
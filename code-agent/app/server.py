@@ -1,8 +1,11 @@
-from flask import Flask, render_template, jsonify, request, abort
-import os, re, json, uuid, shutil, tempfile, subprocess, asyncio
+from flask import Flask, render_template, jsonify, request, abort, Response, stream_with_context
+import os, re, json, uuid, shutil, tempfile, subprocess, asyncio, queue, threading, contextvars
 from pathlib import Path
 from typing import Dict, Any, Tuple
-from util import run_gitleaks, run_semgrep, run_bandit, clone_repo
+from util import run_gitleaks, run_semgrep, run_bandit, diff_base, semgrep_ruleset, refresh_semgrep_rules, NORMALIZERS
+from agentlib.procs import scan_owner
+from agentlib.repos import clone_repo
+from agentlib.findings import dedup_findings, compact_findings
 import requests
 
 app = Flask(__name__)
@@ -14,48 +17,149 @@ REPO_REGEX = re.compile(r"^https://github\.com/[A-Za-z0-9_.\-]+/[A-Za-z0-9_.\-]+
 def hello_world():
     return render_template('index.html')
 
-@app.post("/scan")
-def scan():
-    """
-    POST JSON: { "repo": "https://github.com/owner/repo.git", "ref": "main" (optional) }
-    Returns JSON with each tool's output.
-    """
-    data = request.get_json(silent=True) or {}
+TOOLS = {"gitleaks": run_gitleaks, "semgrep": run_semgrep, "bandit": run_bandit}
+
+
+def _checkout(data: Dict[str, Any]) -> Tuple[Dict[str, Any], str, str]:
+    """Validate a scan request and check out the repo. Returns (scan metadata, tmpdir, repo_path)."""
     repo = (data.get("repo") or "").strip()
     ref  = (data.get("ref") or "HEAD").strip() or "HEAD"
+    base_ref = (data.get("base_ref") or "").strip() or None
     if not REPO_REGEX.match(repo):
-        return abort(400, description="Invalid or disallowed repo URL")
+        abort(400, description="Invalid or disallowed repo URL")
 
     try:
         tmpdir, repo_path = clone_repo(repo, ref)
     except RuntimeError as e:
-        return abort(400, description=str(e))
+        abort(400, description=str(e))
+    base_commit = None
+    if base_ref:
+        try:
+            base_commit = diff_base(repo, repo_path, base_ref)
+        except RuntimeError as e:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            abort(400, description=str(e))
+
+    meta = {"scan_id": str(uuid.uuid4()), "repo": repo, "ref": ref,
+            "base_ref": base_ref, "base_commit": base_commit}
+    return meta, tmpdir, repo_path
+
+
+@app.post("/scan")
+def scan():
+    """
+    POST JSON: { "repo": "https://github.com/owner/repo.git", "ref": "main" (optional),
+                 "base_ref": "main" (optional), "raw": false (optional) }
+    Returns JSON with each tool's output and the deduplicated "normalized" findings;
+    "raw": false leaves out the raw tool output. With base_ref only the changes between
+    base_ref and ref are scanned and findings carry diff_status "new"/"pre-existing".
+    """
+    data = request.get_json(silent=True) or {}
+    meta, tmpdir, repo_path = _checkout(data)
+    scan_owner.set(meta["scan_id"])  # fair-share key for the tool scheduler
 
     async def run_all():
-        t1 = asyncio.to_thread(run_gitleaks, repo_path)
-        t2 = asyncio.to_thread(run_semgrep,  repo_path)
-        t3 = asyncio.to_thread(run_bandit,   repo_path)
-        return await asyncio.gather(t1, t2, t3)
-
-    g_code, g_out = 0, {}
-    s_code, s_out = 0, {}
-    b_code, b_out = 0, {}
+        return await asyncio.gather(*(asyncio.to_thread(fn, repo_path, meta["base_commit"]) for fn in TOOLS.values()))
+
     try:
-        (g_code, g_out), (s_code, s_out), (b_code, b_out) = asyncio.run(run_all())
+        results = dict(zip(TOOLS, asyncio.run(run_all())))
     finally:
         shutil.rmtree(tmpdir, ignore_errors=True)
 
+    normalized = dedup_findings([f for tool, (_, out) in results.items() for f in NORMALIZERS[tool](out, repo_path)])
     merged: Dict[str, Any] = {
-        "scan_id": str(uuid.uuid4()),
-        "repo": repo,
-        "ref": ref,
-        "tool_exit_codes": {"gitleaks": g_code, "semgrep": s_code, "bandit": b_code},
-        "findings": {"gitleaks": g_out, "semgrep": s_out, "bandit": b_out},
+        **meta,
+        "tool_exit_codes": {tool: code for tool, (code, _) in results.items()},
+        "findings": {tool: out for tool, (_, out) in results.items()},
+        "normalized": compact_findings(normalized),
         "message": "ok"
     }
+    if data.get("raw") is False:
+        del merged["findings"]
 
     return jsonify(merged)
 
+
+@app.post("/scan/stream")
+def scan_stream():
+    """
+    Same input as /scan, answered as server-sent events while the tools run:
+    "start" (scan metadata and the tool names), "progress" (a tool's stderr line), "result" (one per tool,
+    as soon as it finishes: tool, exit_code, normalized, findings) and finally "done" with the
+    exit codes and the normalized findings deduplicated across tools.
+    """
+    data = request.get_json(silent=True) or {}
+    raw = data.get("raw") is not False
+    meta, tmpdir, repo_path = _checkout(data)
+    scan_owner.set(meta["scan_id"])
+    events: queue.Queue = queue.Queue()
+    normalized: Dict[str, list] = {}
+
+    def run_tool(name: str, fn) -> None:
+        progress = lambda line: events.put(("progress", {"tool": name, "line": line}))
+        try:
+            code, out = fn(repo_path, meta["base_commit"], on_progress=progress)
+            normalized[name] = NORMALIZERS[name](out, repo_path)
+        except Exception as e:
+            code, out = -1, {"error": str(e)}
+            normalized[name] = []
+        result = {"tool": name, "exit_code": code, "normalized": compact_findings(normalized[name])}
+        if raw:
+            result["findings"] = out
+        events.put(("result", result))
+
+    workers = [threading.Thread(target=contextvars.copy_context().run, args=(run_tool, name, fn), daemon=True)
+               for name, fn in TOOLS.items()]
+    for w in workers:
+        w.start()
+
+    def cleanup() -> None:
+        # independent of the response so the checkout goes away even if the client disconnects
+        for w in workers:
+            w.join()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    threading.Thread(target=cleanup, daemon=True).start()
+
+    def event_stream():
+        yield f"event: start\ndata: {json.dumps({**meta, 'tools': list(TOOLS)})}\n\n"
+        exit_codes: Dict[str, int] = {}
+        while len(exit_codes) < len(TOOLS):
+            try:
+                kind, payload = events.get(timeout=10)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if kind == "result":
+                exit_codes[payload["tool"]] = payload["exit_code"]
+            yield f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+        merged = dedup_findings([f for tool in TOOLS for f in normalized[tool]])
+        done = {**meta, "tool_exit_codes": exit_codes, "normalized": compact_findings(merged), "message": "ok"}
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Connection": "keep-alive",
+        },
+    )
+
+@app.get("/rules")
+def rules():
+    """Active local semgrep ruleset bundle."""
+    return jsonify(semgrep_ruleset() or {"ruleset": None, "version": None})
+
+
+@app.post("/rules/refresh")
+def rules_refresh():
+    """Fetch the semgrep ruleset from the registry and make it the active bundle."""
+    try:
+        return jsonify(refresh_semgrep_rules())
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 502
+
 @app.route("/healthz")
 def healthz(): return "ok", 200
 
@@ -1,58 +1,342 @@
-import json, shutil, tempfile, subprocess
+import os, json, time, heapq, hashlib, shutil, tempfile, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Tuple
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import requests
 
+from agentlib.procs import TOOL_LIMITS, TOOL_MAX_PROCS, TOOL_MEM_BUDGET_MB, run_cmd, run_json_tool
+from agentlib.repos import fetch_ref
+from agentlib.inventory import inventory_files
+from agentlib.findings import make_finding, rel_path
 
-def run_cmd(args: list[str], cwd: str | None=None, timeout: int=120) -> Tuple[int,str,str]:
-    try:
-        p=subprocess.run(args, cwd=cwd, capture_output=True, text=True, timeout=timeout, check=False)
-        return p.returncode, p.stdout.strip(), p.stderr.strip()
-    except subprocess.TimeoutExpired:
-        return -1,"", "timeout"
-    
+
+# Local copy of the semgrep registry ruleset so scans never hit the network
+SEMGREP_RULESET = os.getenv("SEMGREP_RULESET", "p/ci")
+SEMGREP_RULES_DIR = Path(os.getenv("SEMGREP_RULES_DIR", "/tmp/semgrep-rules"))
+SEMGREP_REGISTRY_URL = os.getenv("SEMGREP_REGISTRY_URL", "https://semgrep.dev/c")
+
+# Full scans of trees with more than SHARD_MIN_FILES targets are split across processes
+SHARD_MIN_FILES = int(os.getenv("SHARD_MIN_FILES", "300"))
+SHARD_MAX_FILES = int(os.getenv("SHARD_MAX_FILES", "1000"))
+VENDORED_DIRS = {"vendor", "third_party", "third-party", "bower_components", "site-packages", ".venv", "venv",
+                 ".tox", "__pycache__", "dist", "build", "generated"}
+GENERATED_SUFFIXES = (".min.js", ".min.css", ".map", "_pb2.py", "_pb2_grpc.py", ".pb.go", ".lock")
 
 
-def clone_repo(repo_url: str, ref: str="HEAD") -> Tuple[str,str]:
-    tmpdir = tempfile.mkdtemp(prefix="scan-")
-    repo_path = Path(tmpdir) / "repo"
-    code, out, err = run_cmd(["git","clone","--depth","1", repo_url, str(repo_path)])
+# Admission cost (MB) and niceness of this agent's scanners (see agentlib.procs)
+TOOL_LIMITS.update({
+    "gitleaks": {"mem_mb": 512, "nice": 5},
+    "semgrep":  {"mem_mb": 2048, "nice": 10},
+    "bandit":   {"mem_mb": 512, "nice": 10},
+})
+
+
+def diff_base(repo_url: str, repo_path: str, base_ref: str) -> str:
+    """
+    Fetch base_ref into the mirror backing repo_path and return the merge-base
+    with the checked-out HEAD, i.e. the commit a PR-style diff starts from.
+    """
+    base = fetch_ref(repo_url, base_ref)
+    code, out, err = run_cmd(["git", "-C", repo_path, "merge-base", base, "HEAD"])
     if code != 0:
-        shutil.rmtree(tmpdir, ignore_errors=True)
-        raise RuntimeError(err or "git clone failed")
-    if ref and ref != "HEAD":
-        code, out, err = run_cmd(["git", "-C", str(repo_path), "checkout", ref])
-        if code != 0:
-            shutil.rmtree(tmpdir, ignore_errors=True)
-            raise RuntimeError(err or "git checkout failed")
-    return tmpdir, str(repo_path)
-
-def run_gitleaks(repo_path: str) -> Tuple[int, Any]:
-    cmd = ["gitleaks", "detect", "--source", repo_path, "--report-format", "json", "--redact"]
-    code, out, err = run_cmd(cmd, timeout=120)
-    if code < 0: return code, {"error": err or "gitleaks timeout"}
-    # gitleaks returns exit code 1 when leaks found; output is JSON in stdout
-    try:
-        return code, json.loads(out or "{}")
-    except Exception:
-        return code, {"raw": out, "stderr": err}
+        raise RuntimeError(err or f"no common history between {base_ref} and HEAD")
+    return out
+
+
+def changed_files(repo_path: str, base_commit: str) -> Dict[str, str]:
+    """{path: status} for files added (A) or modified (M) since base_commit."""
+    code, out, err = run_cmd(["git", "-C", repo_path, "diff", "--name-status", "--no-renames",
+                              "--diff-filter=AM", base_commit, "HEAD"])
+    if code != 0:
+        raise RuntimeError(err or "git diff failed")
+    changes: Dict[str, str] = {}
+    for line in out.splitlines():
+        status, _, path = line.partition("\t")
+        if path:
+            changes[path] = status
+    return changes
+
+
+def _tag(out: Any, status: str) -> Any:
+    items = out if isinstance(out, list) else (out.get("results") if isinstance(out, dict) else None)
+    for item in items or []:
+        if isinstance(item, dict):
+            item["diff_status"] = status
+    return out
+
+
+def run_gitleaks(repo_path: str, base_commit: Optional[str]=None,
+                 on_progress: Optional[Callable[[str], None]]=None) -> Tuple[int, Any]:
+    if base_commit:
+        # only commits introduced since the base
+        cmd = ["gitleaks", "detect", "--source", repo_path, "--log-opts", f"{base_commit}..HEAD"]
+    else:
+        # --no-git: scan the checked-out tree, not the mirror's full history
+        cmd = ["gitleaks", "detect", "--no-git", "--source", repo_path]
+    # gitleaks returns exit code 1 when leaks found; "--report-path -" puts the JSON report on stdout
+    cmd += ["--report-format", "json", "--report-path", "-", "--redact"]
+    code, found = run_json_tool(cmd, timeout=120, on_progress=on_progress)
+    return code, _tag(found, "new") if base_commit and code >= 0 else found
     
 
-def run_semgrep(repo_path: str) -> Tuple[int, Any]:
-    cmd = ["semgrep", "--json"]
-    cmd += ["--config", "p/ci", repo_path]
-    code, out, err = run_cmd(cmd, timeout=240)
-    if code < 0: return code, {"error": err or "semgrep timeout"}
+def list_sources(repo_path: str, kind: Optional[str]=None) -> List[Tuple[str, int]]:
+    """(path, size) of scan targets from the repo inventory, minus vendored and generated files."""
+    return [(path, size) for path, size in inventory_files(repo_path, kind)
+            if not path.endswith(GENERATED_SUFFIXES)
+            and not VENDORED_DIRS.intersection(os.path.relpath(path, repo_path).split(os.sep)[:-1])]
+
+
+def make_shards(files: List[Tuple[str, int]], parallel: int=TOOL_MAX_PROCS) -> List[List[str]]:
+    """
+    Split files into at least `parallel` shards of similar total weight (size plus a fixed
+    per-file cost), largest first onto the lightest shard. Returns a single shard for small trees.
+    """
+    if len(files) <= SHARD_MIN_FILES:
+        return [[path for path, _ in files]] if files else []
+    count = max(parallel, -(-len(files) // SHARD_MAX_FILES))
+    heap = [(0, i) for i in range(count)]
+    shards: List[List[str]] = [[] for _ in range(count)]
+    for path, size in sorted(files, key=lambda f: (-f[1], f[0])):
+        weight, i = heapq.heappop(heap)
+        shards[i].append(path)
+        heapq.heappush(heap, (weight + size + 4096, i))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def _run_shards(build_cmd: Callable[[List[str]], List[str]], shards: List[List[str]], timeout: int,
+                on_progress: Optional[Callable[[str], None]]=None, cwd: str | None=None) -> List[Tuple[int, Any]]:
+    # The scheduler bounds how many shards actually run at once; context carries scan_owner
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, run_json_tool, build_cmd(shard), cwd, timeout, on_progress)
+                   for shard in shards]
+        return [f.result() for f in futures]
+
+
+def _merge_codes(parts: List[Tuple[int, Any]]) -> int:
+    codes = [code for code, _ in parts]
+    return min(codes) if min(codes) < 0 else max(codes)
+
+
+def _shard_errors(parts: List[Tuple[int, Any]]) -> List[Dict[str, Any]]:
+    # shards that produced no report (timeout, unparsable output)
+    return [{"shard": i, **out} for i, (_, out) in enumerate(parts) if "results" not in out]
+
+
+def merge_bandit(parts: List[Tuple[int, Any]]) -> Dict[str, Any]:
+    """Combine per-shard bandit reports into one report shaped like a single run."""
+    merged: Dict[str, Any] = {"errors": [], "results": [], "metrics": {}}
+    totals: Dict[str, Any] = {}
+    for out in (out for _, out in parts if "results" in out):
+        merged.setdefault("generated_at", out.get("generated_at"))
+        merged["errors"] += out.get("errors") or []
+        merged["results"] += out.get("results") or []
+        for name, metrics in (out.get("metrics") or {}).items():
+            if name == "_totals":
+                for k, v in metrics.items():
+                    totals[k] = totals.get(k, 0) + v
+            else:
+                merged["metrics"][name] = metrics
+    merged["errors"] += _shard_errors(parts)
+    merged["results"].sort(key=lambda r: (r.get("filename", ""), r.get("line_number", 0), r.get("test_id", "")))
+    merged["metrics"] = {"_totals": totals, **dict(sorted(merged["metrics"].items()))}
+    return merged
+
+
+def merge_semgrep(parts: List[Tuple[int, Any]]) -> Dict[str, Any]:
+    """Combine per-shard semgrep reports into one report shaped like a single run."""
+    merged: Dict[str, Any] = {"results": [], "errors": [], "paths": {"scanned": []}}
+    for out in (out for _, out in parts if "results" in out):
+        for k, v in out.items():
+            if k not in merged:
+                merged[k] = v
+        merged["results"] += out.get("results") or []
+        merged["errors"] += out.get("errors") or []
+        merged["paths"]["scanned"] += (out.get("paths") or {}).get("scanned") or []
+    merged["errors"] += _shard_errors(parts)
+    merged["results"].sort(key=lambda r: (r.get("path", ""), (r.get("start") or {}).get("line", 0),
+                                          (r.get("start") or {}).get("col", 0), r.get("check_id", "")))
+    merged["paths"]["scanned"].sort()
+    return merged
+
+
+_rules_lock = threading.Lock()
+_rules_last_failure = 0.0
+
+
+def _rules_dir() -> Path:
+    return SEMGREP_RULES_DIR / SEMGREP_RULESET.replace("/", "-")
+
+
+def semgrep_ruleset() -> Optional[Dict[str, Any]]:
+    """Manifest of the active local ruleset bundle, or None if none has been fetched."""
+    try:
+        manifest = json.loads((_rules_dir() / "current.json").read_text())
+    except (OSError, ValueError):
+        return None
+    return manifest if Path(manifest.get("path", "")).is_file() else None
+
+
+def refresh_semgrep_rules(keep: int=3) -> Dict[str, Any]:
+    """
+    Download SEMGREP_RULESET from the registry into a new bundle version, validate it
+    with semgrep once and make it the active bundle. The version is the content hash,
+    so an unchanged ruleset keeps its version.
+    """
+    with _rules_lock:
+        try:
+            r = requests.get(f"{SEMGREP_REGISTRY_URL.rstrip('/')}/{SEMGREP_RULESET}", timeout=60)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            raise RuntimeError(f"cannot fetch semgrep ruleset {SEMGREP_RULESET}: {e}")
+        version = hashlib.sha256(r.content).hexdigest()[:12]
+        rules_dir = _rules_dir()
+        rules_dir.mkdir(parents=True, exist_ok=True)
+        path = rules_dir / f"{version}.yml"
+        if path.is_file():
+            os.utime(path)  # re-activated older version: it is the newest again
+        else:
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(r.content)
+            code, out, err = run_cmd(["semgrep", "--validate", "--metrics", "off", "--disable-version-check",
+                                      "--config", str(tmp)], timeout=240)
+            if code != 0:
+                tmp.unlink(missing_ok=True)
+                raise RuntimeError(err or "semgrep rejected the downloaded ruleset")
+            os.replace(tmp, path)
+        manifest = {"ruleset": SEMGREP_RULESET, "version": version, "path": str(path), "fetched_at": int(time.time())}
+        tmp = rules_dir / "current.json.tmp"
+        tmp.write_text(json.dumps(manifest))
+        os.replace(tmp, rules_dir / "current.json")
+        # keep the active bundle plus the keep - 1 most recent others
+        others = [p for p in rules_dir.glob("*.yml") if p != path]
+        for old in sorted(others, key=lambda p: p.stat().st_mtime, reverse=True)[max(keep - 1, 0):]:
+            old.unlink(missing_ok=True)
+        return manifest
+
+
+def _semgrep_config() -> Tuple[List[str], Dict[str, Any]]:
+    global _rules_last_failure
+    manifest = semgrep_ruleset()
+    if manifest is None and time.time() - _rules_last_failure > 300:
+        try:
+            manifest = refresh_semgrep_rules()
+        except RuntimeError:
+            _rules_last_failure = time.time()
+    if manifest is None:
+        # no bundle and no registry access to build one; let semgrep resolve it itself
+        return ["--config", SEMGREP_RULESET], {"ruleset": SEMGREP_RULESET, "version": None}
+    flags = ["--config", manifest["path"], "--metrics", "off", "--disable-version-check"]
+    return flags, {"ruleset": manifest["ruleset"], "version": manifest["version"]}
+
+
+def run_semgrep(repo_path: str, base_commit: Optional[str]=None,
+                on_progress: Optional[Callable[[str], None]]=None) -> Tuple[int, Any]:
+    config, ruleset = _semgrep_config()
+    cmd = ["semgrep", "--json"] + config
+    # only as many shards run at once as the memory budget admits; they split the cores
+    parallel = max(1, min(TOOL_MAX_PROCS, TOOL_MEM_BUDGET_MB // TOOL_LIMITS["semgrep"]["mem_mb"]))
+    shards = [] if base_commit else make_shards(list_sources(repo_path), parallel)
+    if base_commit:
+        # semgrep scans only changed files and drops results already present at the baseline
+        code, found = run_json_tool(cmd + ["--baseline-commit", base_commit, "."], cwd=repo_path,
+                                    timeout=240, on_progress=on_progress)
+    elif not shards:
+        code, found = 0, {"results": [], "errors": [], "paths": {"scanned": []}}
+    elif len(shards) > 1:
+        jobs = max(1, TOOL_MAX_PROCS // min(parallel, len(shards)))
+        parts = _run_shards(lambda shard: cmd + ["-j", str(jobs)] + shard, shards, 240, on_progress, cwd=repo_path)
+        code, found = _merge_codes(parts), merge_semgrep(parts)
+    else:
+        code, found = run_json_tool(cmd + shards[0], cwd=repo_path, timeout=240, on_progress=on_progress)
+    if isinstance(found, dict):
+        found["ruleset"] = ruleset
+    return code, _tag(found, "new") if base_commit and code >= 0 else found
+
+
+def _bandit_key(root: str, res: Dict[str, Any]) -> Tuple[str, str, str]:
+    path = os.path.relpath(res.get("filename", ""), root)
     try:
-        return code, json.loads(out or "{}")
-    except Exception:
-        return code, {"raw": out, "stderr": err}
-
-
-def run_bandit(repo_path: str) -> Tuple[int, Any]:
-    cmd = ["bandit", "-r", repo_path, "-f", "json", "-q"]
-    code, out, err = run_cmd(cmd, timeout=180)
-    if code < 0: return code, {"error": err or "bandit timeout"}
-    try: 
-        return code, json.loads(out or "{}")
-    except Exception:
-        return code, {"raw": out, "stderr": err}
+        with open(os.path.join(root, path), errors="replace") as f:
+            line = f.read().splitlines()[int(res.get("line_number") or 1) - 1].strip()
+    except (OSError, IndexError, ValueError):
+        line = ""
+    # line numbers shift between revisions; the flagged source line does not
+    return path, str(res.get("test_id")), line
+
+
+def _run_bandit_diff(repo_path: str, base_commit: str,
+                     on_progress: Optional[Callable[[str], None]]=None) -> Tuple[int, Any]:
+    py = {p: st for p, st in changed_files(repo_path, base_commit).items() if p.endswith(".py")}
+    if not py:
+        return 0, {"results": [], "errors": []}
+    code, head = run_json_tool(["bandit", "-f", "json", "-q"] + [os.path.join(repo_path, p) for p in py],
+                               timeout=180, on_progress=on_progress)
+    if code < 0 or "results" not in head:
+        return code, head
+
+    # Re-run on the base revision of modified files to tell new from pre-existing issues
+    before: Counter = Counter()
+    modified = [p for p, st in py.items() if st == "M"]
+    if modified:
+        basedir = tempfile.mkdtemp(prefix="scan-base-")
+        try:
+            for p in modified:
+                c, text, _ = run_cmd(["git", "-C", repo_path, "show", f"{base_commit}:{p}"])
+                if c == 0:
+                    Path(basedir, p).parent.mkdir(parents=True, exist_ok=True)
+                    Path(basedir, p).write_text(text + "\n")
+            c, base_out = run_json_tool(["bandit", "-f", "json", "-q"] + [os.path.join(basedir, p) for p in modified], timeout=180)
+            for res in (base_out.get("results") or []) if c >= 0 else []:
+                before[_bandit_key(basedir, res)] += 1
+        finally:
+            shutil.rmtree(basedir, ignore_errors=True)
+
+    for res in head.get("results", []):
+        key = _bandit_key(repo_path, res)
+        if before[key] > 0:
+            before[key] -= 1
+            res["diff_status"] = "pre-existing"
+        else:
+            res["diff_status"] = "new"
+    return code, head
+
+
+def run_bandit(repo_path: str, base_commit: Optional[str]=None,
+               on_progress: Optional[Callable[[str], None]]=None) -> Tuple[int, Any]:
+    if base_commit:
+        return _run_bandit_diff(repo_path, base_commit, on_progress)
+    shards = make_shards(list_sources(repo_path, "python"))
+    if not shards:
+        return 0, {"results": [], "errors": [], "metrics": {}}
+    if len(shards) > 1:
+        parts = _run_shards(lambda shard: ["bandit", "-f", "json", "-q"] + shard, shards, 180, on_progress)
+        return _merge_codes(parts), merge_bandit(parts)
+    return run_json_tool(["bandit", "-f", "json", "-q"] + shards[0], timeout=180, on_progress=on_progress)
+
+
+# ---- Normalized findings ----
+def normalize_gitleaks(out: Any, repo_path: str) -> List[Dict[str, Any]]:
+    return [make_finding("gitleaks", f.get("RuleID"), "HIGH", rel_path(f.get("File"), repo_path),
+                         f.get("StartLine"), f.get("Description"), cwe=798, diff_status=f.get("diff_status"))
+            for f in (out if isinstance(out, list) else []) if isinstance(f, dict)]
+
+
+def normalize_semgrep(out: Any, repo_path: str) -> List[Dict[str, Any]]:
+    found = []
+    for r in (out.get("results") or []) if isinstance(out, dict) else []:
+        extra = r.get("extra") or {}
+        found.append(make_finding("semgrep", r.get("check_id"), extra.get("severity"), rel_path(r.get("path"), repo_path),
+                                  (r.get("start") or {}).get("line"), extra.get("message"),
+                                  cwe=(extra.get("metadata") or {}).get("cwe"), diff_status=r.get("diff_status")))
+    return found
+
+
+def normalize_bandit(out: Any, repo_path: str) -> List[Dict[str, Any]]:
+    return [make_finding("bandit", r.get("test_id"), r.get("issue_severity"), rel_path(r.get("filename"), repo_path),
+                         r.get("line_number"), r.get("issue_text"), cwe=r.get("issue_cwe"),
+                         diff_status=r.get("diff_status"))
+            for r in ((out.get("results") or []) if isinstance(out, dict) else [])]
+
+
+NORMALIZERS = {"gitleaks": normalize_gitleaks, "semgrep": normalize_semgrep, "bandit": normalize_bandit}
@@ -0,0 +1,76 @@
+"""Normalized findings shared by all agents."""
+import os, re, hashlib
+from typing import Any, Dict, List, Optional
+
+# Compact, tool-independent record; agents send these in "normalized" as
+# {"fields": FINDING_FIELDS, "rows": [[...], ...]} next to (or instead of) raw tool JSON.
+# diff_status is "new" / "pre-existing" on diff scans and null on full scans.
+FINDING_FIELDS = ["fingerprint", "tools", "rule_id", "severity", "file", "line", "message", "diff_status"]
+SEVERITY_RANK = {"CRITICAL": 4, "HIGH": 3, "MEDIUM": 2, "LOW": 1, "INFO": 0}
+_SEVERITY_ALIASES = {"ERROR": "HIGH", "WARNING": "MEDIUM", "WARN": "MEDIUM", "NOTE": "LOW", "UNKNOWN": "INFO"}
+
+
+def _severity(value: Any) -> str:
+    sev = str(value or "").upper()
+    sev = _SEVERITY_ALIASES.get(sev, sev)
+    return sev if sev in SEVERITY_RANK else "INFO"
+
+
+def _cwe_id(value: Any) -> Optional[int]:
+    """First CWE number in '78', 'CWE-78: ...', {'id': 78} or a list of those."""
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get("id")
+    m = re.search(r"\d+", str(value or ""))
+    return int(m.group()) if m else None
+
+
+def make_finding(tool: str, rule_id: Any, severity: Any, file: str, line: Any, message: Any,
+                 cwe: Any=None, key: Optional[str]=None, diff_status: Optional[str]=None) -> Dict[str, Any]:
+    """
+    One normalized finding. The fingerprint ignores the tool when a CWE is known, so
+    two scanners flagging the same weakness on the same line collapse into one record.
+    """
+    line = int(line or 0)
+    cwe_id = _cwe_id(cwe)
+    if key is None:
+        key = f"{file}:{line}:CWE-{cwe_id}" if cwe_id else f"{file}:{line}:{tool}:{rule_id}"
+    return {
+        "fingerprint": hashlib.sha1(key.encode()).hexdigest()[:16],
+        "tools": [tool],
+        "rule_id": str(rule_id or ""),
+        "severity": _severity(severity),
+        "file": file,
+        "line": line,
+        "message": " ".join(str(message or "").split())[:200],
+        "diff_status": diff_status,
+    }
+
+
+def dedup_findings(findings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Merge findings sharing a fingerprint (tools unioned, highest severity kept, "new" if
+    any tool reports it as new), most severe first.
+    """
+    by_fp: Dict[str, Dict[str, Any]] = {}
+    for f in findings:
+        seen = by_fp.get(f["fingerprint"])
+        if seen is None:
+            by_fp[f["fingerprint"]] = {**f, "tools": list(f["tools"])}
+            continue
+        seen["tools"] = sorted(set(seen["tools"]) | set(f["tools"]))
+        if f.get("diff_status") == "new" or seen.get("diff_status") is None:
+            seen["diff_status"] = f.get("diff_status") or seen.get("diff_status")
+        if SEVERITY_RANK[f["severity"]] > SEVERITY_RANK[seen["severity"]]:
+            seen.update(rule_id=f["rule_id"], severity=f["severity"], message=f["message"])
+    return sorted(by_fp.values(), key=lambda f: (-SEVERITY_RANK[f["severity"]], f["file"], f["line"], f["rule_id"]))
+
+
+def compact_findings(findings: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"fields": FINDING_FIELDS, "rows": [[f.get(k) for k in FINDING_FIELDS] for f in findings]}
+
+
+def rel_path(path: str, root: str) -> str:
+    path = path or ""
+    return os.path.relpath(path, root) if root and path.startswith(root.rstrip("/") + "/") else path
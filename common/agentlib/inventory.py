@@ -0,0 +1,117 @@
+"""Repository inventory: one classified file listing per checkout, shared by all tool runners."""
+import os, re, json, stat, threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .procs import run_cmd
+
+# One .gitignore-aware listing per checkout, classified once and shared by
+# every tool runner. Cached per commit inside the repo mirror (evicted with it).
+INVENTORY_VERSION = 2
+SKIP_DIRS = {".git", "node_modules"}
+LOCKFILES = {"requirements.txt", "Pipfile.lock", "poetry.lock", "uv.lock", "package-lock.json", "yarn.lock",
+             "pnpm-lock.yaml", "go.sum", "Cargo.lock", "Gemfile.lock", "composer.lock", "packages.lock.json"}
+_DOCKERFILE = re.compile(r"^(Dockerfile(\..+)?|.+\.[Dd]ockerfile)$")
+_K8S_HEAD = re.compile(rb"^apiVersion:.*^kind:|^kind:.*^apiVersion:", re.M | re.S)
+_inventory_memo: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_inventory_lock = threading.Lock()
+
+
+def _list_files(repo_path: str) -> List[str]:
+    code, out, err = run_cmd(["git", "-C", repo_path, "ls-files", "-z", "--cached", "--others", "--exclude-standard"])
+    if code == 0:
+        return [p for p in out.split("\0") if p]
+    found = []  # not a git checkout: plain walk
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        found += [os.path.relpath(os.path.join(root, f), repo_path) for f in files]
+    return found
+
+
+def _classify(repo_path: str, rel: str) -> List[str]:
+    name = os.path.basename(rel)
+    kinds = []
+    if _DOCKERFILE.match(name):
+        kinds.append("dockerfile")
+    if name.endswith(".py"):
+        kinds.append("python")
+    if name in LOCKFILES:
+        kinds.append("lockfile")
+    if name == "Chart.yaml":
+        kinds.append("helm_chart")
+    if name in ("kustomization.yaml", "kustomization.yml", "Kustomization"):
+        kinds.append("kustomization")
+    if name.endswith((".yml", ".yaml")):
+        kinds.append("yaml")
+        try:
+            with open(os.path.join(repo_path, rel), "rb") as f:
+                if _K8S_HEAD.search(f.read(8192)):
+                    kinds.append("k8s_manifest")
+        except OSError:
+            pass
+    return kinds
+
+
+def build_inventory(repo_path: str) -> Dict[str, Any]:
+    """
+    {"commit", "files": {relpath: size}, "categories": {kind: [relpath, ...]}} for a checkout.
+    Kinds: dockerfile, python, yaml, k8s_manifest, helm_chart (chart dirs),
+    kustomization (overlay dirs), lockfile.
+    """
+    files: Dict[str, int] = {}
+    categories: Dict[str, List[str]] = {}
+    for rel in sorted(_list_files(repo_path)):
+        if SKIP_DIRS.intersection(rel.split("/")[:-1]):
+            continue
+        try:
+            st = os.lstat(os.path.join(repo_path, rel))
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue  # symlinks, submodules
+        files[rel] = st.st_size
+        for kind in _classify(repo_path, rel):
+            entry = (os.path.dirname(rel) or ".") if kind in ("helm_chart", "kustomization") else rel
+            categories.setdefault(kind, []).append(entry)
+    # chart templates look like manifests but are not YAML until rendered
+    templates = tuple("templates/" if d == "." else f"{d}/templates/" for d in categories.get("helm_chart", []))
+    if templates and "k8s_manifest" in categories:
+        categories["k8s_manifest"] = [rel for rel in categories["k8s_manifest"] if not rel.startswith(templates)]
+    return {"version": INVENTORY_VERSION, "files": files, "categories": categories}
+
+
+def repo_inventory(repo_path: str) -> Dict[str, Any]:
+    """build_inventory, memoized per checkout and cached on disk per commit."""
+    with _inventory_lock:
+        if repo_path in _inventory_memo:
+            return _inventory_memo[repo_path]
+    code, sha, _ = run_cmd(["git", "-C", repo_path, "rev-parse", "HEAD"])
+    c2, common, _ = run_cmd(["git", "-C", repo_path, "rev-parse", "--path-format=absolute", "--git-common-dir"])
+    cache = Path(common) / "inventory" / f"{sha}-v{INVENTORY_VERSION}.json" if code == 0 and c2 == 0 else None
+    inv = None
+    if cache is not None:
+        try:
+            inv = json.loads(cache.read_text())
+        except (OSError, ValueError):
+            pass
+    if inv is None:
+        inv = build_inventory(repo_path)
+        inv["commit"] = sha if code == 0 else None
+        if cache is not None:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(inv))
+            os.replace(tmp, cache)
+    with _inventory_lock:
+        _inventory_memo[repo_path] = inv
+        while len(_inventory_memo) > 32:
+            _inventory_memo.popitem(last=False)
+    return inv
+
+
+def inventory_files(repo_path: str, kind: Optional[str]=None) -> List[Tuple[str, int]]:
+    """(absolute path, size) of every inventoried file, or of one kind of file."""
+    inv = repo_inventory(repo_path)
+    rels = inv["categories"].get(kind, []) if kind else inv["files"]
+    return [(os.path.join(repo_path, rel), inv["files"].get(rel, 0)) for rel in rels]
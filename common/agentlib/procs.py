@@ -0,0 +1,202 @@
+"""Scanner subprocesses: a process-wide fair-share gate plus run helpers."""
+import os, json, subprocess, signal, threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:  # incremental JSON parsing of scanner output; without it reports are parsed at EOF
+    import ijson
+except ImportError:
+    ijson = None
+
+
+TOOL_MAX_PROCS = int(os.getenv("TOOL_MAX_PROCS", str(os.cpu_count() or 2)))
+TOOL_MEM_BUDGET_MB = int(os.getenv("TOOL_MEM_BUDGET_MB", "4096"))
+# Cap each tool's address space at 4x its mem_mb (prlimit) when enabled
+TOOL_ENFORCE_MEM = os.getenv("TOOL_ENFORCE_MEM", "0") == "1"
+
+# Admission cost (MB) and niceness per scanner binary. Commands not listed here
+# (git, ...) are cheap and bypass the scheduler.
+TOOL_LIMITS: Dict[str, Dict[str, int]] = {}  # filled in by each agent's util.py
+
+# Fair-share key for run_cmd; servers set it to the scan id before starting tools.
+# asyncio.to_thread copies the context, so tool threads inherit it.
+scan_owner: ContextVar[str] = ContextVar("scan_owner", default="")
+
+
+class ToolScheduler:
+    """
+    Process-wide gate in front of scanner subprocesses. A process runs once a slot
+    and its memory cost are free; waiting scans are served round-robin so one big
+    scan cannot starve the others.
+    """
+
+    def __init__(self, max_procs: int, mem_budget_mb: int):
+        self.max_procs = max(1, max_procs)
+        self.mem_budget_mb = max(1, mem_budget_mb)
+        self._procs = 0
+        self._mem = 0
+        self._cond = threading.Condition()
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+
+    def _can_start(self, owner: str, ticket: object, mem_mb: int) -> bool:
+        head_owner = next(iter(self._queues))
+        return (head_owner == owner and self._queues[owner][0] is ticket
+                and self._procs < self.max_procs and self._mem + mem_mb <= self.mem_budget_mb)
+
+    @contextmanager
+    def slot(self, owner: str, mem_mb: int) -> Iterator[None]:
+        mem_mb = min(mem_mb, self.mem_budget_mb)  # an oversized tool may still run alone
+        ticket = object()
+        with self._cond:
+            self._queues.setdefault(owner, deque()).append(ticket)
+            while not self._can_start(owner, ticket, mem_mb):
+                self._cond.wait()
+            self._queues[owner].popleft()
+            if self._queues[owner]:
+                self._queues.move_to_end(owner)  # next turn goes to another scan
+            else:
+                del self._queues[owner]
+            self._procs += 1
+            self._mem += mem_mb
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._procs -= 1
+                self._mem -= mem_mb
+                self._cond.notify_all()
+
+
+SCHEDULER = ToolScheduler(TOOL_MAX_PROCS, TOOL_MEM_BUDGET_MB)
+
+
+def kill_group(p: subprocess.Popen) -> None:
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _exec(args: List[str], cwd: str | None, timeout: int) -> Tuple[int,str,str]:
+    # Own session per command so a timeout takes down every child the tool spawned
+    p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         text=True, start_new_session=True)
+    try:
+        out, err = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_group(p)
+        p.communicate()
+        return -1, "", "timeout"
+    kill_group(p)  # reap anything the tool left running in the background
+    return p.returncode, out.strip(), err.strip()
+
+
+@contextmanager
+def _tool_slot(args: List[str]) -> Iterator[List[str]]:
+    """Wait for a scheduler slot if args[0] is a scanner; yields the command to run."""
+    limits = TOOL_LIMITS.get(os.path.basename(args[0]))
+    if not limits:
+        yield args
+        return
+    prefix = ["nice", "-n", str(limits["nice"])]
+    if TOOL_ENFORCE_MEM:
+        prefix += ["prlimit", f"--as={limits['mem_mb'] * 4 * 1024 * 1024}", "--"]
+    with SCHEDULER.slot(scan_owner.get(), limits["mem_mb"]):
+        yield prefix + args
+
+
+def run_cmd(args: List[str], cwd: str | None=None, timeout: int=120) -> Tuple[int,str,str]:
+    with _tool_slot(args) as cmd:
+        return _exec(cmd, cwd, timeout)
+
+
+class _PipeHead:
+    """File-like view of a pipe for ijson that keeps the first bytes for error reports."""
+
+    def __init__(self, pipe: Any, keep: int=1 << 16):
+        self.pipe, self.keep = pipe, keep
+        self.head = bytearray()
+        self.total = 0
+
+    def read(self, n: int=-1) -> bytes:
+        if n == 0:
+            return b""  # ijson probes bytes vs str with read(0); it must not consume output
+        chunk = self.pipe.read1(n) if n > 0 else self.pipe.read1()
+        self.total += len(chunk)
+        if len(self.head) < self.keep:
+            self.head += chunk[:self.keep - len(self.head)]
+        return chunk
+
+
+def _parse_stream(pipe: Any) -> Tuple[Any, Optional[bytes]]:
+    """(document, None) parsed while the pipe fills, or (None, first bytes) if it is not JSON."""
+    src = _PipeHead(pipe)
+    try:
+        doc = next(ijson.items(src, "", use_float=True), None)
+    except (ijson.JSONError, ValueError):
+        doc = None
+        if src.total == 0:
+            return {}, None
+    while src.read():
+        pass  # trailing output; drain so the tool can exit
+    return (doc, None) if doc is not None else (None, bytes(src.head))
+
+
+def run_json_tool(args: List[str], cwd: str | None=None, timeout: int=120,
+                  on_progress: Optional[Callable[[str], None]]=None) -> Tuple[int, Any]:
+    """
+    Run a scanner that prints one JSON document on stdout and return (exit code, parsed output).
+    With ijson installed the document is built incrementally as the bytes arrive, so no copy
+    of the raw report is held; otherwise stdout is read as raw bytes and parsed once at EOF.
+    Either way the text decode/strip copies of run_cmd are avoided. stderr lines are passed
+    to on_progress as they arrive.
+    """
+    name = os.path.basename(args[0])
+    with _tool_slot(args) as cmd:
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             start_new_session=True)
+        tail: deque = deque(maxlen=50)
+
+        def pump_stderr() -> None:
+            for raw in p.stderr:
+                line = raw.decode("utf-8", "replace").rstrip()
+                if line:
+                    tail.append(line)
+                    if on_progress:
+                        on_progress(line)
+
+        timed_out = threading.Event()
+        def expire() -> None:
+            timed_out.set()
+            kill_group(p)
+
+        reader = threading.Thread(target=pump_stderr, daemon=True)
+        reader.start()
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        buf = bytearray()
+        doc: Any = None
+        try:
+            if ijson is not None:
+                doc, head = _parse_stream(p.stdout)
+                buf += head or b""
+            else:
+                while chunk := p.stdout.read1(1 << 16):
+                    buf += chunk
+            p.wait()
+        finally:
+            timer.cancel()
+            kill_group(p)
+            reader.join(timeout=5)
+    err = "\n".join(tail)
+    if timed_out.is_set():
+        return -1, {"error": f"{name} timeout"}
+    if doc is not None:
+        return p.returncode, doc
+    try:
+        return p.returncode, json.loads(buf or b"{}")
+    except ValueError:
+        return p.returncode, {"raw": buf.decode("utf-8", "replace").strip(), "stderr": err}
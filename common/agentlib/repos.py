@@ -0,0 +1,130 @@
+"""Bare mirror cache of scanned repos; scans check out worktrees of it."""
+import os, fcntl, hashlib, shutil, tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from .procs import run_cmd
+
+# Bare mirrors of scanned repos, one per URL, reused across scans
+REPO_CACHE_DIR = Path(os.getenv("REPO_CACHE_DIR", "/tmp/repo-cache"))
+REPO_CACHE_MAX_BYTES = int(os.getenv("REPO_CACHE_MAX_MB", "4096")) * 1024 * 1024
+
+
+@contextmanager
+def _repo_lock(mirror: Path, blocking: bool=True) -> Iterator[bool]:
+    """flock on a sidecar file; serializes fetch/checkout/evict of one mirror."""
+    REPO_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = f"{mirror}.lock"
+    while True:
+        fh = open(path, "a")
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.close()
+            yield False
+            return
+        try:
+            if os.path.samestat(os.fstat(fh.fileno()), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+        fh.close()  # lock file was unlinked by an eviction while we waited: retry on the new one
+    with fh:
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _mirror_path(repo_url: str) -> Path:
+    key = repo_url.strip().rstrip("/").removesuffix(".git").lower()
+    return REPO_CACHE_DIR / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.git"
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _fetch_locked(mirror: Path, repo_url: str, ref: str) -> str:
+    # caller holds _repo_lock(mirror)
+    if not (mirror / "HEAD").exists():
+        shutil.rmtree(mirror, ignore_errors=True)
+        code, out, err = run_cmd(["git", "init", "--bare", "-q", str(mirror)])
+        if code != 0:
+            raise RuntimeError(err or "git init failed")
+        run_cmd(["git", "-C", str(mirror), "remote", "add", "origin", repo_url])
+    run_cmd(["git", "-C", str(mirror), "worktree", "prune"])
+    # Keep every fetched ref under refs/cache/ so later fetches negotiate against it
+    # and only transfer new objects.
+    local = f"refs/cache/{hashlib.sha1(ref.encode()).hexdigest()[:16]}"
+    code, out, err = run_cmd(["git", "-C", str(mirror), "fetch", "--no-tags", "-q", "origin", f"+{ref}:{local}"], timeout=600)
+    if code != 0:
+        raise RuntimeError(err or "git fetch failed")
+    code, sha, err = run_cmd(["git", "-C", str(mirror), "rev-parse", "--verify", f"{local}^{{commit}}"])
+    if code != 0:
+        raise RuntimeError(err or f"cannot resolve {ref}")
+    os.utime(mirror)  # LRU stamp
+    return sha
+
+
+def _evict_mirrors(keep: Path) -> None:
+    """Drop least recently used mirrors until the cache fits REPO_CACHE_MAX_BYTES."""
+    stamps = {}
+    for m in REPO_CACHE_DIR.glob("*.git"):
+        try:
+            stamps[m] = m.stat().st_mtime
+        except FileNotFoundError:
+            pass  # evicted by a concurrent scan
+    mirrors = sorted(stamps, key=stamps.get)
+    sizes = {m: _dir_size(m) for m in mirrors}
+    total = sum(sizes.values())
+    for m in mirrors:
+        if total <= REPO_CACHE_MAX_BYTES:
+            break
+        if m == keep:
+            continue
+        with _repo_lock(m, blocking=False) as locked:
+            if not locked:
+                continue
+            run_cmd(["git", "-C", str(m), "worktree", "prune"])
+            if any((m / "worktrees").glob("*")):
+                continue  # still checked out by a running scan
+            shutil.rmtree(m, ignore_errors=True)
+            Path(f"{m}.lock").unlink(missing_ok=True)
+            total -= sizes[m]
+
+
+def fetch_ref(repo_url: str, ref: str) -> str:
+    """Fetch ref into repo_url's mirror (only missing objects) and return its commit."""
+    mirror = _mirror_path(repo_url)
+    with _repo_lock(mirror):
+        return _fetch_locked(mirror, repo_url, ref)
+
+
+def clone_repo(repo_url: str, ref: str="HEAD") -> Tuple[str,str]:
+    """
+    Check out repo_url@ref into a fresh temp dir as a worktree of the cached mirror.
+    Only objects missing from the mirror are fetched; removing tmpdir releases the checkout.
+    """
+    mirror = _mirror_path(repo_url)
+    tmpdir = tempfile.mkdtemp(prefix="scan-")
+    repo_path = Path(tmpdir) / "repo"
+    try:
+        with _repo_lock(mirror):
+            sha = _fetch_locked(mirror, repo_url, ref or "HEAD")
+            code, out, err = run_cmd(["git", "-C", str(mirror), "worktree", "add", "-q", "--detach", str(repo_path), sha])
+            if code != 0:
+                raise RuntimeError(err or "git checkout failed")
+        _evict_mirrors(keep=mirror)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return tmpdir, str(repo_path)
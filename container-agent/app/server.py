@@ -4,9 +4,13 @@ import json
 import os
 import shutil
 import asyncio
+import threading
 import uuid
 from typing import Any, Dict
-from util import clone_repo, run_trivy
+from util import run_trivy, rescan_sboms, trivy_db_version, TRIVY, normalize_trivy
+from agentlib.procs import scan_owner
+from agentlib.repos import clone_repo
+from agentlib.findings import dedup_findings, compact_findings
 import re
 app = Flask(__name__)
 
@@ -19,8 +23,9 @@ def index():
 @app.post("/scan")
 def scan():
     """
-    POST JSON: { "repo": "https://github.com/owner/repo.git", "ref": "main" (optional) }
-    Returns JSON with each tool's output.
+    POST JSON: { "repo": "https://github.com/owner/repo.git", "ref": "main" (optional), "raw": false (optional) }
+    Returns JSON with each tool's output and the deduplicated "normalized" findings;
+    "raw": false leaves out the raw tool output.
     """
     data = request.get_json(silent=True) or {}
     repo = (data.get("repo") or "").strip()
@@ -33,8 +38,11 @@ def scan():
     except RuntimeError as e:
         return abort(400, description=str(e))
 
+    scan_id = str(uuid.uuid4())
+    scan_owner.set(scan_id)  # fair-share key for the tool scheduler
+
     async def run_all():
-        t1 = asyncio.to_thread(run_trivy, repo_path)
+        t1 = asyncio.to_thread(run_trivy, repo_path, repo)
         results = await asyncio.gather(t1)
         return results[0]  # Extract the first (and only) result
 
@@ -45,19 +53,51 @@ def scan():
         shutil.rmtree(tmpdir, ignore_errors=True)
 
     merged: Dict[str, Any] = {
-        "scan_id": str(uuid.uuid4()),
+        "scan_id": scan_id,
         "repo": repo,
         "ref": ref,
         "tool_exit_codes": {"trivy": t_code},
         "findings": {"trivy": t_out},
+        "normalized": compact_findings(dedup_findings(normalize_trivy(t_out, repo_path))),
         "message": "ok"
     }
+    if data.get("raw") is False:
+        del merged["findings"]
 
     return jsonify(merged)
 
+@app.post("/rescan")
+def rescan():
+    """
+    POST JSON: { "repos": ["https://github.com/owner/repo", ...] (optional, default all), "raw": false (optional) }
+    Re-matches the SBOMs stored by earlier scans against the current vulnerability DB.
+    Nothing is cloned or pulled; each repo's latest scanned commit and its base images are covered.
+    """
+    data = request.get_json(silent=True) or {}
+    repos = data.get("repos")
+    if repos is not None and not (isinstance(repos, list) and all(isinstance(r, str) for r in repos)):
+        return abort(400, description="repos must be a list of repo URLs")
+    scan_owner.set(str(uuid.uuid4()))
+
+    results = []
+    for entry in rescan_sboms(repos):
+        item: Dict[str, Any] = {
+            "repo": entry["repo"],
+            "commit": entry["commit"],
+            "findings": {"trivy": entry["trivy"]},
+            "normalized": compact_findings(dedup_findings(normalize_trivy(entry["trivy"], ""))),
+        }
+        if data.get("raw") is False:
+            del item["findings"]
+        results.append(item)
+
+    return jsonify({"db_version": trivy_db_version(), "results": results, "message": "ok"})
+
 @app.route("/healthz")
 def healthz():
     return jsonify({"status": "ok"})
 
 if __name__ == "__main__":
+    # warm the trivy server (and its DB) before the first scan asks for it
+    threading.Thread(target=TRIVY.url, daemon=True).start()
     app.run(host="0.0.0.0", port=5001)
@@ -1,75 +1,479 @@
-import os, json, shutil, tempfile, subprocess
+import os, re, json, time, uuid, hashlib, shutil, tempfile, subprocess, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import requests
 
-def run_cmd(args: list[str], cwd: str | None=None, timeout: int=120) -> Tuple[int,str,str]:
+from agentlib.procs import TOOL_LIMITS, run_cmd, kill_group
+from agentlib.inventory import repo_inventory, inventory_files
+from agentlib.findings import make_finding
+
+
+# Base image scans: resolved to digests, run in parallel, cached per (digest, vuln DB)
+IMAGE_SCAN_WORKERS = int(os.getenv("IMAGE_SCAN_WORKERS", "4"))
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", "/tmp/trivy-image-cache"))
+RESOLVE_DIGESTS = os.getenv("RESOLVE_DIGESTS", "1") == "1"
+REGISTRY_TIMEOUT = float(os.getenv("REGISTRY_TIMEOUT", "10"))
+
+# Long-lived trivy server holding the vulnerability DB; scans run as thin clients.
+# Set TRIVY_SERVER_URL to use an existing server instead of starting one.
+TRIVY_CACHE_DIR = os.getenv("TRIVY_CACHE_DIR", "/tmp/trivy-cache")
+TRIVY_SERVER_ADDR = os.getenv("TRIVY_SERVER_ADDR", "127.0.0.1:4954")
+TRIVY_SERVER_URL = os.getenv("TRIVY_SERVER_URL", "")
+TRIVY_SERVER_START_TIMEOUT = int(os.getenv("TRIVY_SERVER_START_TIMEOUT", "300"))
+
+# CycloneDX SBOMs per (repo, commit) and per image digest, re-matched by /rescan
+SBOM_DIR = Path(os.getenv("SBOM_DIR", "/tmp/sboms"))
+# Unreferenced image SBOMs younger than this may belong to a scan still in progress
+SBOM_IMAGE_GRACE = int(os.getenv("SBOM_IMAGE_GRACE", "3600"))  # seconds
+
+
+# Admission cost (MB) and niceness of this agent's scanners (see agentlib.procs)
+TOOL_LIMITS.update({
+    "trivy": {"mem_mb": 1024, "nice": 5},
+})
+
+
+class TrivyServer:
+    """
+    Lazily started `trivy server` sharing TRIVY_CACHE_DIR. The server loads and updates
+    the DB once; clients only send package lists. If it cannot be started, url()
+    returns None for a while and scans fall back to standalone trivy on the same cache.
+    """
+
+    def __init__(self, addr: str):
+        self.addr = addr
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        self._failed_at = 0.0
+
+    def _healthy(self, url: str) -> bool:
+        try:
+            return requests.get(f"{url}/healthz", timeout=2).ok
+        except requests.RequestException:
+            return False
+
+    def url(self) -> Optional[str]:
+        if TRIVY_SERVER_URL:
+            return TRIVY_SERVER_URL.rstrip("/")
+        url = f"http://{self.addr}"
+        proc = self._proc
+        if proc is not None and proc.poll() is None:
+            return url  # health is probed only at startup; a live server stays in use
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                return url  # started by another thread meanwhile
+            if time.time() - self._failed_at < 300:
+                return None
+            self.stop()
+            # first start downloads the DB, hence the long wait
+            proc = subprocess.Popen(["trivy", "server", "--listen", self.addr, "--cache-dir", TRIVY_CACHE_DIR],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            deadline = time.time() + TRIVY_SERVER_START_TIMEOUT
+            while time.time() < deadline and proc.poll() is None:
+                if self._healthy(url):
+                    self._proc = proc  # published only once it serves requests
+                    return url
+                time.sleep(1)
+            kill_group(proc)
+            proc.wait()
+            self._failed_at = time.time()
+            return None
+
+    def stop(self) -> None:
+        if self._proc is not None:
+            kill_group(self._proc)
+            self._proc.wait()
+            self._proc = None
+
+
+TRIVY = TrivyServer(TRIVY_SERVER_ADDR)
+
+
+def trivy_cmd(subcommand: str, *args: str) -> List[str]:
+    """trivy invocation that runs as a client of the shared server when one is available."""
+    url = TRIVY.url()
+    mode = ["--server", url] if url else ["--cache-dir", TRIVY_CACHE_DIR]
+    return ["trivy", subcommand, "--format", "json", *mode, *args]
+
+
+_ARG_REF = re.compile(r"\$\{(\w+)(?::?-([^}]*))?\}|\$(\w+)")
+
+
+def _dockerfile_lines(text: str) -> Iterator[str]:
+    """Logical instructions: comments dropped, backslash continuations joined."""
+    buf = ""
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not buf and (not stripped or stripped.startswith("#")):
+            continue
+        if stripped.endswith("\\"):
+            buf += stripped[:-1] + " "
+            continue
+        yield buf + stripped
+        buf = ""
+    if buf:
+        yield buf
+
+
+def dockerfile_images(text: str) -> List[str]:
+    """
+    Base images of every stage in a Dockerfile. Global ARG defaults are substituted;
+    references to earlier stages, scratch and images with unresolved ARGs are skipped.
+    """
+    args: Dict[str, str] = {}
+    stages: set = set()
+    images: List[str] = []
+    seen_from = False
+
+    def expand(value: str) -> Optional[str]:
+        """value with ARG references substituted; None if one has neither a value nor a default."""
+        unresolved = False
+
+        def sub(m: "re.Match[str]") -> str:
+            nonlocal unresolved
+            found = args.get(m.group(1) or m.group(3)) or m.group(2)
+            unresolved = unresolved or not found
+            return found or ""
+        value = _ARG_REF.sub(sub, value)
+        return None if unresolved else value
+
+    for line in _dockerfile_lines(text):
+        instr, _, rest = line.partition(" ")
+        instr = instr.upper()
+        if instr == "ARG" and not seen_from:  # only ARGs before the first FROM apply to FROM
+            for decl in rest.split():
+                name, eq, value = decl.partition("=")
+                args[name] = (expand(value.strip("\"'")) or "") if eq else args.get(name, "")
+        elif instr == "FROM":
+            seen_from = True
+            tokens = [t for t in rest.split() if not t.startswith("--")]
+            if not tokens:
+                continue
+            image = expand(tokens[0])
+            if len(tokens) >= 3 and tokens[1].upper() == "AS":
+                stages.add(tokens[2].lower())
+            if image and "$" not in image and image.lower() not in stages and image != "scratch":
+                images.append(image)
+    return images
+
+
+def _split_image(image: str) -> Tuple[str, str, str]:
+    """image ref -> (registry host, repository, tag or digest)"""
+    name, _, digest = image.partition("@")
+    tag = ""
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+    first, _, remainder = name.partition("/")
+    if remainder and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, remainder
+    else:
+        registry, repository = "docker.io", name
+    if registry == "docker.io":
+        registry = "registry-1.docker.io"
+        if "/" not in repository:
+            repository = f"library/{repository}"
+    return registry, repository, digest or tag or "latest"
+
+
+_digest_cache: Dict[str, Tuple[float, Optional[str]]] = {}
+
+
+def resolve_digest(image: str) -> Optional[str]:
+    """
+    Manifest digest an image ref points to, asked from the registry (anonymous token
+    if required). Tags can move, so answers are kept for 10 minutes. None if unknown.
+    """
+    if "@sha256:" in image:
+        return image.split("@", 1)[1]
+    if not RESOLVE_DIGESTS:
+        return None
+    cached = _digest_cache.get(image)
+    if cached and time.time() - cached[0] < 600:
+        return cached[1]
+    registry, repository, reference = _split_image(image)
+    url = f"https://{registry}/v2/{repository}/manifests/{reference}"
+    headers = {"Accept": ", ".join([
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ])}
+    digest = None
     try:
-        p=subprocess.run(args, cwd=cwd, capture_output=True, text=True, timeout=timeout, check=False)
-        return p.returncode, p.stdout.strip(), p.stderr.strip()
-    except subprocess.TimeoutExpired:
-        return -1,"", "timeout"
-    
+        r = requests.head(url, headers=headers, timeout=REGISTRY_TIMEOUT)
+        if r.status_code == 401 and r.headers.get("WWW-Authenticate", "").startswith("Bearer "):
+            params = dict(re.findall(r'(\w+)="([^"]*)"', r.headers["WWW-Authenticate"]))
+            realm = params.pop("realm", "")
+            token = requests.get(realm, params=params, timeout=REGISTRY_TIMEOUT).json()
+            headers["Authorization"] = f"Bearer {token.get('token') or token.get('access_token')}"
+            r = requests.head(url, headers=headers, timeout=REGISTRY_TIMEOUT)
+        if r.ok:
+            digest = r.headers.get("Docker-Content-Digest")
+    except (requests.RequestException, ValueError):
+        pass
+    _digest_cache[image] = (time.time(), digest)
+    return digest
+
+
+def trivy_db_version() -> str:
+    """UpdatedAt of the shared vulnerability DB ('' if unknown); part of the image cache key."""
+    code, out, err = run_cmd(["trivy", "version", "--format", "json", "--cache-dir", TRIVY_CACHE_DIR], timeout=30)
+    try:
+        return str((json.loads(out).get("VulnerabilityDB") or {}).get("UpdatedAt") or "")
+    except (ValueError, AttributeError):
+        return ""
+
+
+def _image_cache_path(digest: str, db_version: str) -> Path:
+    return IMAGE_CACHE_DIR / hashlib.sha256(db_version.encode()).hexdigest()[:16] / f"{digest.replace(':', '-')}.json"
+
 
-def clone_repo(repo_url: str, ref: str="HEAD") -> Tuple[str,str]:
-    tmpdir = tempfile.mkdtemp(prefix="scan-")
-    repo_path = Path(tmpdir) / "repo"
-    code, out, err = run_cmd(["git","clone","--depth","1", repo_url, str(repo_path)])
-    if code != 0:
-        shutil.rmtree(tmpdir, ignore_errors=True)
-        raise RuntimeError(err or "git clone failed")
-    if ref and ref != "HEAD":
-        code, out, err = run_cmd(["git", "-C", str(repo_path), "checkout", ref])
-        if code != 0:
-            shutil.rmtree(tmpdir, ignore_errors=True)
-            raise RuntimeError(err or "git checkout failed")
-    return tmpdir, str(repo_path)
-
-def run_trivy(repo_path: str) -> Tuple[int, Any]:
-    cmd = ["trivy", "fs", "--format", "json", "--output", "trivy-report.json", repo_path]
-    code, out, err = run_cmd(cmd, timeout=120)
+def _store_image_report(digest: str, db_version: str, report: Any) -> None:
+    path = _image_cache_path(digest, db_version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp.write_text(json.dumps(report))
+    os.replace(tmp, path)
+    # reports computed against older DBs are stale now
+    for old in IMAGE_CACHE_DIR.iterdir():
+        if old != path.parent:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def _strip_packages(report: Any) -> Any:
+    """Drop the --list-all-pkgs package lists once the SBOM has been written."""
+    for res in (report.get("Results") or []) if isinstance(report, dict) else []:
+        res.pop("Packages", None)
+    return report
+
+
+def store_sbom(report: Any, path: Path) -> bool:
+    """Write a trivy JSON report made with --list-all-pkgs to path as CycloneDX (no re-analysis)."""
+    if not isinstance(report, dict) or "SchemaVersion" not in report:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(report, f)
+    try:
+        code, out, err = run_cmd(["trivy", "convert", "--format", "cyclonedx", f.name], timeout=60)
+    finally:
+        os.unlink(f.name)
+    if code != 0 or not out:
+        return False
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp.write_text(out)
+    os.replace(tmp, path)
+    return True
+
+
+def _repo_sbom_dir(repo_url: str) -> Path:
+    key = repo_url.strip().rstrip("/").removesuffix(".git").lower()
+    return SBOM_DIR / "repos" / hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _image_sbom_path(digest: str) -> Path:
+    return SBOM_DIR / "images" / f"{digest.replace(':', '-')}.cdx.json"
+
+
+def _scan_image(target: str) -> Any:
+    code, out, err = run_cmd(trivy_cmd("image", "--list-all-pkgs", target), timeout=120)
+    if code < 0:
+        return {"error": err or "trivy timeout"}
+    try:
+        return json.loads(out or "{}")
+    except Exception:
+        return {"raw": out, "stderr": err}
+
+
+def scan_images(images: List[str]) -> Tuple[Dict[str, Any], Dict[str, Optional[str]]]:
+    """
+    Scan each distinct image once. Refs resolving to the same digest share one scan, and
+    reports cached for that digest under the current DB version are reused.
+    Returns ({image ref: report}, {image ref: digest}).
+    """
+    images = sorted(set(images))
+    with ThreadPoolExecutor(max_workers=max(1, IMAGE_SCAN_WORKERS)) as pool:
+        digests = dict(zip(images, pool.map(resolve_digest, images)))
+    db_version = trivy_db_version()
+
+    # one scan target per digest (or per ref when the registry could not be asked)
+    targets: Dict[str, str] = {}
+    for image in images:
+        key = digests[image] or image
+        if key not in targets:
+            name = image.split("@", 1)[0]
+            if digests[image] and ":" in name.rsplit("/", 1)[-1]:
+                name = name.rsplit(":", 1)[0]
+            targets[key] = f"{name}@{digests[image]}" if digests[image] else image
+
+    reports: Dict[str, Any] = {}
+    pending: List[str] = []
+    for key in targets:
+        try:
+            if key.startswith("sha256:") and _image_sbom_path(key).exists():  # else rescan to restore it
+                reports[key] = json.loads(_image_cache_path(key, db_version).read_text())
+                continue
+        except (OSError, ValueError):
+            pass
+        pending.append(key)
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, IMAGE_SCAN_WORKERS)) as pool:
+            futures = {key: pool.submit(contextvars.copy_context().run, _scan_image, targets[key]) for key in pending}
+            for key, fut in futures.items():
+                reports[key] = fut.result()
+        db_version = trivy_db_version()  # the scans may have refreshed the DB
+        for key in pending:
+            if key.startswith("sha256:") and not _image_sbom_path(key).exists():
+                store_sbom(reports[key], _image_sbom_path(key))
+            _strip_packages(reports[key])
+            if db_version and key.startswith("sha256:") and isinstance(reports[key], dict) and "SchemaVersion" in reports[key]:
+                _store_image_report(key, db_version, reports[key])
+
+    return {image: reports[digests[image] or image] for image in images}, digests
+
+
+def _record_repo_sbom(repo_url: str, repo_path: str, fs_results: Any, digests: Dict[str, Optional[str]]) -> None:
+    commit = repo_inventory(repo_path).get("commit")
+    if not commit:
+        return
+    repo_dir = _repo_sbom_dir(repo_url)
+    if not (repo_dir / f"{commit}.cdx.json").exists() and not store_sbom(fs_results, repo_dir / f"{commit}.cdx.json"):
+        return
+    meta = {"repo": repo_url, "latest": commit, "images": sorted({d for d in digests.values() if d}),
+            "updated_at": int(time.time())}
+    tmp = repo_dir / f"meta.{uuid.uuid4().hex}.tmp"
+    tmp.write_text(json.dumps(meta))
+    os.replace(tmp, repo_dir / "meta.json")
+    for old in repo_dir.glob("*.cdx.json"):
+        if old.name != f"{commit}.cdx.json":
+            old.unlink(missing_ok=True)
+    _prune_image_sboms()
+
+
+def _prune_image_sboms() -> None:
+    """Drop image SBOMs that no repo's meta.json refers to any more."""
+    used = set()
+    for meta_path in (SBOM_DIR / "repos").glob("*/meta.json"):
+        try:
+            used.update(_image_sbom_path(d).name for d in json.loads(meta_path.read_text()).get("images") or [])
+        except (OSError, ValueError):
+            return  # unreadable (being replaced?): keep everything this time
+    cutoff = time.time() - SBOM_IMAGE_GRACE
+    for path in (SBOM_DIR / "images").glob("*.cdx.json"):
+        try:
+            if path.name not in used and path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def run_trivy(repo_path: str, repo_url: Optional[str]=None) -> Tuple[int, Any]:
+    # report goes to stdout; --output would leave stdout empty.
+    # --list-all-pkgs lets the report double as the SBOM source for /rescan.
+    code, out, err = run_cmd(trivy_cmd("fs", "--list-all-pkgs", repo_path), timeout=120)
     if code < 0: return code, {"error": err or "trivy timeout"}
     
-    ### Scan image
+    ### Scan base images of every stage of every Dockerfile
     img_names = []
-    for root, dirs, files in os.walk(repo_path):
-        for file in files:
-            if file == "Dockerfile":
-                dockerfile_path = os.path.join(root, file)
-                try:
-                    with open(dockerfile_path, 'r') as f:
-                        for line in f:
-                            line = line.strip()
-                            if line.upper().startswith('FROM '):
-                                # Extract image name from FROM instruction
-                                # Handle cases like "FROM ubuntu:22.04", "FROM python:3.11-alpine AS builder"
-                                parts = line.split()
-                                if len(parts) >= 2:
-                                    img_names.append(parts[1])  # Get the image name after FROM
-                                    break
-                except Exception:
-                    continue  # Skip if can't read Dockerfile
-
-    # If we found an image name, scan it with trivy
-    img_results = {}
-    for img_name in img_names:
-        cmd_img = ["trivy", "image", "--format", "json", img_name]
-        code_img, out_img_raw, err_img = run_cmd(cmd_img, timeout=120)
-        if code_img < 0:
-            img_results[img_name] = {"error": err_img or "trivy timeout"}
-        else:
-            try:
-                img_results[img_name] = json.loads(out_img_raw or "{}")
-            except Exception:
-                img_results[img_name] = {"raw": out_img_raw, "stderr": err_img}
+    for dockerfile_path, _ in inventory_files(repo_path, "dockerfile"):
+        try:
+            with open(dockerfile_path, 'r', errors="replace") as f:
+                img_names += dockerfile_images(f.read())
+        except OSError:
+            continue  # Skip if can't read Dockerfile
+    img_results, img_digests = scan_images(img_names)
             
     try:
         fs_results = json.loads(out or "{}")
+        if repo_url:
+            _record_repo_sbom(repo_url, repo_path, fs_results, img_digests)
+        _strip_packages(fs_results)
         # Combine filesystem and image results
         combined_results = {
             "filesystem": fs_results,
-            "images": img_results
+            "images": img_results,
+            "image_digests": img_digests,
         }
         return code, combined_results
     except Exception:
-        return code, {"raw": out, "stderr": err, "images": img_results}
\ No newline at end of file
+        return code, {"raw": out, "stderr": err, "images": img_results, "image_digests": img_digests}
+
+
+def _scan_sbom(path: Path) -> Any:
+    code, out, err = run_cmd(trivy_cmd("sbom", str(path)), timeout=120)
+    if code < 0:
+        return {"error": err or "trivy timeout"}
+    try:
+        return json.loads(out or "{}")
+    except Exception:
+        return {"raw": out, "stderr": err}
+
+
+def rescan_sboms(repos: Optional[List[str]]=None) -> List[Dict[str, Any]]:
+    """
+    Re-match stored SBOMs against the current vulnerability DB, without cloning or pulling:
+    the latest scanned commit of every stored repo (or only `repos`) plus the images it uses.
+    Returns [{"repo", "commit", "trivy": {"filesystem", "images", "image_digests"}}, ...].
+    """
+    wanted = {_repo_sbom_dir(r) for r in repos} if repos else None
+    metas = []
+    for meta_path in sorted((SBOM_DIR / "repos").glob("*/meta.json")):
+        if wanted is not None and meta_path.parent not in wanted:
+            continue
+        try:
+            metas.append((meta_path.parent, json.loads(meta_path.read_text())))
+        except (OSError, ValueError):
+            continue
+
+    sboms: Dict[str, Path] = {}
+    for repo_dir, meta in metas:
+        sboms[f"repo:{repo_dir.name}"] = repo_dir / f"{meta['latest']}.cdx.json"
+        for digest in meta.get("images") or []:
+            sboms[digest] = _image_sbom_path(digest)
+    sboms = {key: path for key, path in sboms.items() if path.exists()}
+
+    with ThreadPoolExecutor(max_workers=max(1, IMAGE_SCAN_WORKERS)) as pool:
+        futures = {key: pool.submit(contextvars.copy_context().run, _scan_sbom, path) for key, path in sboms.items()}
+        reports = {key: fut.result() for key, fut in futures.items()}
+
+    results = []
+    for repo_dir, meta in metas:
+        images = {d: reports[d] for d in meta.get("images") or [] if d in reports}
+        results.append({
+            "repo": meta["repo"],
+            "commit": meta["latest"],
+            "trivy": {"filesystem": reports.get(f"repo:{repo_dir.name}", {"error": "sbom missing"}),
+                      "images": images, "image_digests": {d: d for d in images}},
+        })
+    return results
+
+
+# ---- Normalized findings ----
+def _normalize_trivy_report(report: Any) -> List[Dict[str, Any]]:
+    found = []
+    for res in (report.get("Results") or []) if isinstance(report, dict) else []:
+        target = res.get("Target") or ""
+        for v in res.get("Vulnerabilities") or []:
+            pkg = f"{v.get('PkgName')} {v.get('InstalledVersion')}"
+            # one record per (target, package, CVE): a shared CWE must not merge different CVEs
+            found.append(make_finding("trivy", v.get("VulnerabilityID"), v.get("Severity"), target, 0,
+                                      f"{pkg}: {v.get('Title') or v.get('Description') or ''}",
+                                      key=f"{target}:{pkg}:{v.get('VulnerabilityID')}"))
+        for m in res.get("Misconfigurations") or []:
+            found.append(make_finding("trivy", m.get("ID") or m.get("AVDID"), m.get("Severity"), target,
+                                      (m.get("CauseMetadata") or {}).get("StartLine"), m.get("Title") or m.get("Message")))
+        for sec in res.get("Secrets") or []:
+            found.append(make_finding("trivy", sec.get("RuleID"), sec.get("Severity"), target,
+                                      sec.get("StartLine"), sec.get("Title"), cwe=798))
+    return found
+
+
+def normalize_trivy(out: Any, repo_path: str) -> List[Dict[str, Any]]:
+    if not isinstance(out, dict):
+        return []
+    found = _normalize_trivy_report(out.get("filesystem"))
+    for report in (out.get("images") or {}).values():
+        found += _normalize_trivy_report(report)
+    return found
@@ -2,37 +2,20 @@ from flask import Flask, request, jsonify, abort, render_template
 import os, re, json, uuid, shutil, tempfile, subprocess, asyncio
 from pathlib import Path
 from typing import Dict, Any, Tuple, List
+from util import prepare_manifests, opa_eval_docs, NORMALIZERS
+from agentlib.procs import run_cmd, scan_owner
+from agentlib.repos import clone_repo
+from agentlib.findings import dedup_findings, compact_findings
 
 app = Flask(__name__)
 
 REPO_REGEX = re.compile(r"^https?://github\.com/[A-Za-z0-9_.\-]+/[A-Za-z0-9_.\-]+(\.git)?$")
 
 
-def run_cmd(args: List[str], cwd: str | None=None, timeout: int=120) -> Tuple[int,str,str]:
-    try:
-        p = subprocess.run(args, cwd=cwd, capture_output=True, text=True, timeout=timeout, check=False)
-        return p.returncode, p.stdout.strip(), p.stderr.strip()
-    except subprocess.TimeoutExpired:
-        return -1, "", "timeout"
-
-
-def clone_repo(repo_url: str, ref: str="HEAD") -> Tuple[str,str]:
-    tmpdir = tempfile.mkdtemp(prefix="scan-")
-    repo_path = Path(tmpdir) / "repo"
-    code, out, err = run_cmd(["git","clone","--depth","1", repo_url, str(repo_path)])
-    if code != 0:
-        shutil.rmtree(tmpdir, ignore_errors=True)
-        raise RuntimeError(err or "git clone failed")
-    if ref and ref != "HEAD":
-        code, out, err = run_cmd(["git", "-C", str(repo_path), "checkout", ref])
-        if code != 0:
-            shutil.rmtree(tmpdir, ignore_errors=True)
-            raise RuntimeError(err or "git checkout failed")
-    return tmpdir, str(repo_path)
-
-
-def run_kubelinter(repo_path: str) -> Tuple[int, Any]:
-    cmd = ["kube-linter", "lint", repo_path, "--format", "json"]
+def run_kubelinter(manifests: Dict[str, Any]) -> Tuple[int, Any]:
+    if not manifests["docs"]:
+        return 0, {"Reports": []}
+    cmd = ["kube-linter", "lint", manifests["dir"], "--format", "json"]
     code, out, err = run_cmd(cmd, timeout=180)
     if code < 0: return code, {"error": err or "kube-linter timeout"}
     try:
@@ -41,31 +24,14 @@ def run_kubelinter(repo_path: str) -> Tuple[int, Any]:
         return code, {"raw": out, "stderr": err}
 
 
-def run_opa(repo_path: str) -> Tuple[int, Any]:
+def run_opa(manifests: Dict[str, Any]) -> Tuple[int, Any]:
     # Optional: evaluate example policy against manifests; if no policies, return empty
     policies_dir = Path(__file__).parent / "policies"
-    if not policies_dir.exists():
-        return 0, {"results": []}
-
-    # Find YAML files
-    manifest_files: List[str] = []
-    for root, _, files in os.walk(repo_path):
-        for f in files:
-            if f.endswith(('.yml', '.yaml')):
-                manifest_files.append(os.path.join(root, f))
-    if not manifest_files:
+    if not policies_dir.exists() or not manifests["docs"]:
         return 0, {"results": []}
 
-    results: List[Dict[str, Any]] = []
-    for mf in manifest_files:
-        code, out, err = run_cmd(["opa", "eval", "-f", "json", "-d", str(policies_dir), "-i", mf, "data"], timeout=60)
-        if code < 0:
-            results.append({"file": mf, "error": err or "opa timeout"})
-        else:
-            try:
-                results.append({"file": mf, "data": json.loads(out or "{}")})
-            except Exception:
-                results.append({"file": mf, "raw": out, "stderr": err})
+    # policies compiled once (OPA server), objects evaluated in batches
+    results = opa_eval_docs(str(policies_dir), manifests["docs"])
     return 0, {"results": results}
 
 
@@ -75,6 +41,12 @@ def index():
 
 @app.post("/scan")
 def scan():
+    """
+    POST JSON: { "repo": "https://github.com/owner/repo.git", "ref": "main" (optional), "raw": false (optional) }
+    Returns JSON with each tool's output, a summary of the manifests linted (plain files plus
+    rendered Helm charts / Kustomize overlays) and the deduplicated "normalized" findings;
+    "raw": false leaves out the raw tool output.
+    """
     data = request.get_json(silent=True) or {}
     repo = (data.get("repo") or "").strip()
     ref  = (data.get("ref") or "HEAD").strip() or "HEAD"
@@ -86,26 +58,36 @@ def scan():
     except RuntimeError as e:
         return abort(400, description=str(e))
 
-    async def run_all():
-        t1 = asyncio.to_thread(run_kubelinter, repo_path)
-        t2 = asyncio.to_thread(run_opa, repo_path)
+    scan_id = str(uuid.uuid4())
+    scan_owner.set(scan_id)  # fair-share key for the tool scheduler
+
+    async def run_all(manifests):
+        t1 = asyncio.to_thread(run_kubelinter, manifests)
+        t2 = asyncio.to_thread(run_opa, manifests)
         return await asyncio.gather(t1, t2)
 
     kl_code, kl_out = 0, {}
     opa_code, opa_out = 0, {}
     try:
-        (kl_code, kl_out), (opa_code, opa_out) = asyncio.run(run_all())
+        # parsed, filtered and rendered once; both linters read the staged copy
+        manifests = prepare_manifests(repo_path, os.path.join(tmpdir, "manifests"))
+        (kl_code, kl_out), (opa_code, opa_out) = asyncio.run(run_all(manifests))
     finally:
         shutil.rmtree(tmpdir, ignore_errors=True)
 
     merged: Dict[str, Any] = {
-        "scan_id": str(uuid.uuid4()),
+        "scan_id": scan_id,
         "repo": repo,
         "ref": ref,
         "tool_exit_codes": {"kube-linter": kl_code, "opa": opa_code},
         "findings": {"kube-linter": kl_out, "opa": opa_out},
+        "manifests": manifests["summary"],
+        "normalized": compact_findings(dedup_findings(NORMALIZERS["kube-linter"](kl_out, manifests["dir"])
+                                                      + NORMALIZERS["opa"](opa_out, manifests["dir"]))),
         "message": "ok"
     }
+    if data.get("raw") is False:
+        del merged["findings"]
 
     return jsonify(merged)
 
@@ -0,0 +1,400 @@
+import os, re, json, time, hashlib, shutil, tempfile, subprocess, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import requests
+import yaml
+
+from agentlib.procs import SCHEDULER, TOOL_LIMITS, scan_owner, run_cmd, kill_group
+from agentlib.inventory import repo_inventory
+from agentlib.findings import make_finding, rel_path
+
+
+# Policies are compiled once by a long-lived `opa run --server`; manifests are sent in batches
+OPA_SERVER_ADDR = os.getenv("OPA_SERVER_ADDR", "127.0.0.1:8181")
+OPA_WORKERS = int(os.getenv("OPA_WORKERS", "4"))
+OPA_BATCH_FILES = int(os.getenv("OPA_BATCH_FILES", "200"))
+OPA_BATCH_BYTES = int(os.getenv("OPA_BATCH_KB", "4096")) * 1024
+
+# Helm charts and Kustomize overlays rendered locally; output cached by input content hash
+RENDER_CACHE_DIR = Path(os.getenv("RENDER_CACHE_DIR", "/tmp/render-cache"))
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_MB", "256")) * 1024 * 1024
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
+
+
+# Admission cost (MB) and niceness of this agent's scanners (see agentlib.procs)
+TOOL_LIMITS.update({
+    "kube-linter": {"mem_mb": 512, "nice": 5},
+    "opa":         {"mem_mb": 256, "nice": 5},
+    "helm":        {"mem_mb": 256, "nice": 5},
+    "kustomize":   {"mem_mb": 256, "nice": 5},
+})
+
+
+# ---- Manifest pipeline ----
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+_HELM_SOURCE = re.compile(r"^# Source: (\S+)", re.M)
+_DOC_SEPARATOR = re.compile(r"^---[ \t]*$", re.M)
+_KUSTOMIZE_FILES = ("kustomization.yaml", "kustomization.yml", "Kustomization")
+# kustomize's own config; only meaningful once built
+_KUSTOMIZE_KINDS = {"Kustomization", "Component"}
+
+
+def k8s_documents(text: str) -> List[Dict[str, Any]]:
+    """Kubernetes objects in a YAML stream: mappings with apiVersion and kind, lists flattened."""
+    try:
+        docs = list(yaml.load_all(text, Loader=_Loader))
+    except yaml.YAMLError:
+        return []
+    found = []
+    for doc in docs:
+        if not isinstance(doc, dict) or not doc.get("apiVersion") or not doc.get("kind"):
+            continue
+        if doc["kind"] in _KUSTOMIZE_KINDS and str(doc["apiVersion"]).startswith("kustomize.config.k8s.io/"):
+            continue
+        if doc["kind"] == "List" and isinstance(doc.get("items"), list):
+            found += [d for d in doc["items"] if isinstance(d, dict) and d.get("apiVersion") and d.get("kind")]
+        else:
+            found.append(doc)
+    return found
+
+
+def _kustomize_refs(repo_path: str, kdir: str) -> Tuple[Set[str], Set[str]]:
+    """Repo-relative (dirs, files) a kustomization points at: any string value naming a local path."""
+    for name in _KUSTOMIZE_FILES:
+        try:
+            data = yaml.load(Path(repo_path, kdir, name).read_text(errors="replace"), Loader=_Loader)
+            break
+        except (OSError, yaml.YAMLError):
+            continue
+    else:
+        return set(), set()
+    dirs: Set[str] = set()
+    files: Set[str] = set()
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack += value.values()
+        elif isinstance(value, list):
+            stack += value
+        elif isinstance(value, str) and "://" not in value and "\n" not in value and len(value) < 512:
+            rel = os.path.normpath(os.path.join(kdir, value))
+            if rel == ".." or rel.startswith("../") or rel == kdir:
+                continue
+            full = os.path.join(repo_path, rel)
+            if os.path.isdir(full):
+                dirs.add(rel)
+            elif os.path.isfile(full):
+                files.add(rel)
+    return dirs, files
+
+
+def _inputs_digest(repo_path: str, tool: str, dirs: Set[str], files: Set[str]) -> str:
+    """Content hash over everything a render reads, plus the renderer binary itself."""
+    h = hashlib.sha256(tool.encode())
+    binary = shutil.which(tool)
+    if binary:
+        st = os.stat(binary)
+        h.update(f"{st.st_size}:{st.st_mtime_ns}".encode())
+    prefixes = tuple("" if d == "." else f"{d}/" for d in dirs)
+    for rel in sorted(repo_inventory(repo_path)["files"]):
+        if rel in files or rel.startswith(prefixes):
+            h.update(b"\0" + rel.encode() + b"\0")
+            try:
+                h.update(hashlib.sha256(Path(repo_path, rel).read_bytes()).digest())
+            except OSError:
+                pass
+    return h.hexdigest()
+
+
+def _render(repo_path: str, tool: str, src: str, dirs: Set[str], files: Set[str]) -> Tuple[Optional[str], bool, str]:
+    """(rendered YAML or None, served from cache, error) for one chart or overlay."""
+    cache = RENDER_CACHE_DIR / f"{_inputs_digest(repo_path, tool, dirs, files)}.yaml"
+    try:
+        text = cache.read_text()
+        os.utime(cache)  # LRU stamp for _evict_renders
+        return text, True, ""
+    except OSError:
+        pass
+    if shutil.which(tool) is None:
+        return None, False, f"{tool} not installed"
+    target = os.path.join(repo_path, src)
+    args = ["helm", "template", "scan", target] if tool == "helm" else ["kustomize", "build", target]
+    code, out, err = run_cmd(args, timeout=120)
+    if code != 0:
+        return None, False, err or f"{tool} exited with {code}"
+    RENDER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(out)
+    os.replace(tmp, cache)
+    _evict_renders()
+    return out, False, ""
+
+
+def _evict_renders() -> None:
+    """Drop least recently used renders (mtime, touched on hits) until the cache fits RENDER_CACHE_MAX_BYTES."""
+    entries = []
+    for path in RENDER_CACHE_DIR.glob("*.yaml"):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue  # evicted concurrently
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RENDER_CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def _outermost(dirs: List[str]) -> List[str]:
+    """Drop dirs nested in another listed dir (subcharts render with their parent)."""
+    return [d for d in dirs if not any(o != d and (o == "." or d.startswith(f"{o}/")) for o in dirs)]
+
+
+def prepare_manifests(repo_path: str, stage_dir: str) -> Dict[str, Any]:
+    """
+    Parse, filter and render a checkout's Kubernetes manifests once, for every linter.
+    Plain manifests are kept as-is (minus non-object documents); Helm charts are rendered and
+    attributed to their templates, Kustomize overlays to <overlay>/kustomize.rendered.yaml.
+    The objects are written under stage_dir mirroring the repo layout, so paths relative
+    to stage_dir are repo paths. Returns {"dir", "docs": [(staged file, object)], "summary"}.
+    """
+    inv = repo_inventory(repo_path)
+    categories = inv["categories"]
+    staged: Dict[str, List[Dict[str, Any]]] = {}
+    summary: Dict[str, Any] = {"files": 0, "documents": 0, "rendered": {"helm": [], "kustomize": []},
+                               "render_cache_hits": 0, "errors": []}
+
+    charts = _outermost(categories.get("helm_chart", []))
+    kdirs = categories.get("kustomization", [])
+    refs = {k: _kustomize_refs(repo_path, k) for k in kdirs}
+    referenced = set().union(*(d for d, _ in refs.values())) if refs else set()
+
+    jobs = [("helm", c, {c}, set()) for c in charts]
+    for k in kdirs:
+        if k in referenced:
+            continue  # a base; rendered as part of the overlays using it
+        dirs, files, todo = {k}, set(), [k]
+        while todo:
+            d, f = refs[todo.pop()]
+            files |= f
+            todo += [x for x in d - dirs if x in refs]
+            dirs |= d
+        jobs.append(("kustomize", k, dirs, files))
+
+    with ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS)) as pool:
+        futures = [(job, pool.submit(contextvars.copy_context().run, _render, repo_path, *job)) for job in jobs]
+        covered_dirs: Set[str] = set()
+        covered_files: Set[str] = set()
+        for (tool, src, dirs, files), fut in futures:
+            text, hit, err = fut.result()
+            if text is None:
+                summary["errors"].append({"tool": tool, "source": src, "error": err[-500:]})
+                continue
+            summary["rendered"][tool].append(src)
+            summary["render_cache_hits"] += hit
+            covered_dirs |= dirs
+            covered_files |= files
+            if tool == "helm":
+                for chunk in _DOC_SEPARATOR.split(text):
+                    m = _HELM_SOURCE.search(chunk)
+                    # "<chart name>/templates/x.yaml" -> "<chart dir>/templates/x.yaml"
+                    rel = os.path.normpath(os.path.join(src, m.group(1).split("/", 1)[-1] if m else "helm.rendered.yaml"))
+                    staged.setdefault(rel, []).extend(k8s_documents(chunk))
+            else:
+                # not named kustomization.yaml, or kube-linter would try to build the staged dir itself
+                staged.setdefault(os.path.normpath(os.path.join(src, "kustomize.rendered.yaml")), []).extend(k8s_documents(text))
+
+    # plain manifests not already covered by a successful render
+    chart_prefixes = tuple("" if c == "." else f"{c}/" for c in summary["rendered"]["helm"])
+    kustomize_prefixes = tuple(f"{d}/" for d in covered_dirs if d != ".")
+    for rel in categories.get("k8s_manifest", []):
+        if rel in covered_files or (os.path.dirname(rel) or ".") in covered_dirs:
+            continue
+        if (chart_prefixes and rel.startswith(chart_prefixes)) or (kustomize_prefixes and rel.startswith(kustomize_prefixes)):
+            continue
+        try:
+            text = Path(repo_path, rel).read_text(errors="replace")
+        except OSError:
+            continue
+        staged.setdefault(rel, []).extend(k8s_documents(text))
+
+    docs: List[Tuple[str, Dict[str, Any]]] = []
+    for rel, objs in sorted(staged.items()):
+        if not objs:
+            continue
+        path = os.path.join(stage_dir, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            yaml.dump_all(objs, f, Dumper=_Dumper, sort_keys=False)
+        docs += [(path, obj) for obj in objs]
+    summary["files"] = len({p for p, _ in docs})
+    summary["documents"] = len(docs)
+    os.makedirs(stage_dir, exist_ok=True)
+    return {"dir": stage_dir, "docs": docs, "summary": summary}
+
+
+# ---- OPA policy evaluation ----
+# Each object is evaluated as its own input, like `opa eval -i <manifest> data`
+_OPA_BATCH_QUERY = "r := {k: v | some k; v := data with input as input.docs[k]}"
+
+
+class OpaServer:
+    """
+    Lazily started `opa run --server` with the policy directory loaded (and watched).
+    If it cannot be started, url() returns None for a while and batches fall back to
+    one `opa eval` per batch.
+    """
+
+    def __init__(self, addr: str):
+        self.addr = addr
+        self.policies: Optional[str] = None
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        self._failed_at = 0.0
+
+    def _healthy(self, url: str) -> bool:
+        try:
+            return requests.get(f"{url}/health", timeout=2).ok
+        except requests.RequestException:
+            return False
+
+    def url(self, policies: str) -> Optional[str]:
+        url = f"http://{self.addr}"
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None and self.policies == policies:
+                return url
+            if self.policies == policies and time.time() - self._failed_at < 300:
+                return None
+            self.stop()
+            self.policies = policies
+            self._proc = subprocess.Popen(["opa", "run", "--server", "--addr", self.addr, "--watch", policies],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            deadline = time.time() + 30
+            while time.time() < deadline and self._proc.poll() is None:
+                if self._healthy(url):
+                    return url
+                time.sleep(0.2)
+            self.stop()
+            self._failed_at = time.time()
+            return None
+
+    def stop(self) -> None:
+        if self._proc is not None:
+            kill_group(self._proc)
+            self._proc.wait()
+            self._proc = None
+
+
+OPA = OpaServer(OPA_SERVER_ADDR)
+
+
+def _opa_batches(docs: List[Tuple[str, Dict[str, Any]]]) -> Iterator[Dict[str, str]]:
+    """{index: object as JSON} batches, bounded by count and serialized size."""
+    batch: Dict[str, str] = {}
+    size = 0
+    for i, (_, doc) in enumerate(docs):
+        text = json.dumps(doc, default=str)  # YAML timestamps come back as datetime
+        if batch and (len(batch) >= OPA_BATCH_FILES or size + len(text) > OPA_BATCH_BYTES):
+            yield batch
+            batch, size = {}, 0
+        batch[str(i)] = text
+        size += len(text)
+    if batch:
+        yield batch
+
+
+def _opa_eval_batch(policies: str, batch: Dict[str, str]) -> Dict[str, Any]:
+    """{index: data document} for one batch, or {"error": ...} for the whole batch."""
+    body = '{"docs": {%s}}' % ", ".join(f"{json.dumps(k)}: {v}" for k, v in batch.items())
+    url = OPA.url(policies)
+    if url:
+        try:
+            with SCHEDULER.slot(scan_owner.get(), TOOL_LIMITS["opa"]["mem_mb"]):
+                r = requests.post(f"{url}/v1/query", data='{"query": %s, "input": %s}' % (json.dumps(_OPA_BATCH_QUERY), body),
+                                  headers={"Content-Type": "application/json"}, timeout=60)
+            r.raise_for_status()
+            return (r.json().get("result") or [{}])[0].get("r") or {}
+        except (requests.RequestException, ValueError) as e:
+            return {"error": str(e)}
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        f.write(body)
+    try:
+        code, out, err = run_cmd(["opa", "eval", "-f", "json", "-d", policies, "-i", f.name, _OPA_BATCH_QUERY], timeout=120)
+    finally:
+        os.unlink(f.name)
+    if code < 0:
+        return {"error": err or "opa timeout"}
+    try:
+        return (json.loads(out or "{}").get("result") or [{}])[0].get("bindings", {}).get("r") or {}
+    except (ValueError, AttributeError):
+        return {"error": err or out}
+
+
+def opa_eval_docs(policies: str, docs: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Evaluate `data` against each (file, object) in batches on a bounded worker pool.
+    Results keep the per-input `opa eval -f json` shape: {"file", "data": {"result": [...]}}.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, OPA_WORKERS)) as pool:
+        futures = [(batch, pool.submit(contextvars.copy_context().run, _opa_eval_batch, policies, batch))
+                   for batch in _opa_batches(docs)]
+        results: List[Dict[str, Any]] = []
+        for batch, fut in futures:
+            values = fut.result()
+            for key in batch:
+                path = docs[int(key)][0]
+                if key not in values:
+                    results.append({"file": path, "error": values.get("error") or "no result"})
+                else:
+                    results.append({"file": path, "data": {"result": [{"expressions": [
+                        {"value": values[key], "text": "data", "location": {"row": 1, "col": 1}}]}]}})
+    return results
+
+
+# ---- Normalized findings ----
+def normalize_kubelinter(out: Any, repo_path: str) -> List[Dict[str, Any]]:
+    found = []
+    for rep in (out.get("Reports") or []) if isinstance(out, dict) else []:
+        obj = rep.get("Object") or {}
+        k8s = obj.get("K8sObject") or {}
+        name = f"{(k8s.get('GroupVersionKind') or {}).get('Kind', '')}/{k8s.get('Name', '')}"
+        file = rel_path((obj.get("Metadata") or {}).get("FilePath"), repo_path)
+        found.append(make_finding("kube-linter", rep.get("Check"), "MEDIUM", file, 0,
+                                  f"{name}: {(rep.get('Diagnostic') or {}).get('Message', '')}",
+                                  key=f"{file}:{name}:{rep.get('Check')}"))
+    return found
+
+
+_OPA_RULES = {"deny": "HIGH", "violation": "HIGH", "warn": "MEDIUM"}
+
+
+def _opa_messages(value: Any, path: str) -> Iterator[Tuple[str, str, Any]]:
+    """(rule path, severity, message) for every deny/violation/warn entry in an OPA data document."""
+    if not isinstance(value, dict):
+        return
+    for k, v in value.items():
+        if k in _OPA_RULES and isinstance(v, list):
+            for item in v:
+                yield f"{path}{k}", _OPA_RULES[k], item.get("msg") if isinstance(item, dict) else item
+        elif isinstance(v, dict):
+            yield from _opa_messages(v, f"{path}{k}.")
+
+
+def normalize_opa(out: Any, repo_path: str) -> List[Dict[str, Any]]:
+    found = []
+    for entry in (out.get("results") or []) if isinstance(out, dict) else []:
+        file = rel_path(entry.get("file"), repo_path)
+        for res in (entry.get("data") or {}).get("result") or []:
+            for expr in res.get("expressions") or []:
+                for rule, severity, msg in _opa_messages(expr.get("value"), ""):
+                    found.append(make_finding("opa", rule, severity, file, 0, msg, key=f"{file}:{rule}:{msg}"))
+    return found
+
+
+NORMALIZERS = {"kube-linter": normalize_kubelinter, "opa": normalize_opa}
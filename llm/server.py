@@ -1,6 +1,6 @@
 from flask import Flask, request, jsonify, render_template, Response, stream_with_context, make_response
-import os, json, requests, time
-from typing import Any, Dict, List
+import os, json, requests, time, threading, uuid
+from typing import Any, Dict, List, Optional, Tuple
 from util import _norm_text
 
 app = Flask(__name__)
@@ -16,6 +16,9 @@ def index():
 LLM_MODEL = os.getenv("LLM_MODEL", "openai/gpt-oss-20b")
 LLM_URL = os.getenv("LLM_URL", "http://host.docker.internal:1234")
 REQUEST_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))  # seconds
+# Scan sessions: prefill the prompt upstream while the scan is still running
+PREFILL_WARM = os.getenv("LLM_PREFILL_WARM", "1") == "1"
+SESSION_TTL = float(os.getenv("LLM_SESSION_TTL", "900"))  # seconds
 
 
 def heuristic_analysis(payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -41,7 +44,18 @@ def heuristic_analysis(payload: Dict[str, Any]) -> Dict[str, Any]:
     has_leaks = bool(
         (isinstance(leaks, dict))
         and (leaks.get("findings") or leaks.get("leaks") or leaks.get("Results"))
-    )
+    ) or (isinstance(leaks, list) and bool(leaks))
+
+    # Compact agent output ({"fields": [...], "rows": [[...], ...]}) sent without raw findings
+    normalized = payload.get("normalized")
+    if root is None and isinstance(normalized, dict) and "rows" in normalized:
+        fields = normalized.get("fields") or []
+        for row in normalized["rows"]:
+            f = dict(zip(fields, row))
+            if "trivy" in (f.get("tools") or []) and f.get("severity") in trivy_counts:
+                trivy_counts[f["severity"]] += 1
+            if "gitleaks" in (f.get("tools") or []):
+                has_leaks = True
 
     score = (
         trivy_counts["CRITICAL"] * 3
@@ -62,16 +76,19 @@ def heuristic_analysis(payload: Dict[str, Any]) -> Dict[str, Any]:
     return summary
 
 
-def _chat_payload(messages: Any, model: str, temperature: float, stream: bool):
+def _chat_payload(messages: Any, model: str, temperature: float, stream: bool, max_tokens: int | None = None):
     # Accept string or OpenAI-style messages
     if isinstance(messages, str):
         messages = [{"role": "user", "content": messages}]
-    return {
+    payload = {
         "model": model,
         "messages": messages,
         "temperature": temperature,
         "stream": stream,
     }
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+    return payload
 
 
 def _parse_stream_line(line: str) -> str:
@@ -151,68 +168,82 @@ def generate_once(messages: Any, model: str, temperature: float) -> str:
         raise
 
 
+def warm_prefix(prompt: str, model: str) -> None:
+    """
+    Have the upstream prefill `prompt` (one output token) so a later prompt starting with it
+    only pays for the rest, on servers with prefix caching (vLLM, llama.cpp, Ollama).
+    """
+    payload = _chat_payload(prompt, model, 0.2, stream=False, max_tokens=1)
+    r = requests.post(f"{LLM_URL.rstrip('/')}/v1/chat/completions", json=payload, timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+
+
+PROMPT_PREFIX = (
+    "You are a senior cybersecurity analyst conducting a comprehensive security assessment. "
+    "Analyze the security scan results below and provide a detailed, actionable report.\n\n"
+    
+    "## Analysis Requirements:\n"
+    "1. **Risk Assessment**: Provide an overall risk score (0-10) with clear justification\n"
+    "2. **Critical Findings**: Identify the most severe vulnerabilities that need immediate attention\n"
+    "3. **Impact Analysis**: Explain potential business/security impact of key findings\n"
+    "4. **Remediation Roadmap**: Prioritized action items with timelines (immediate/short-term/long-term)\n"
+    "5. **Patching**: Provide a list of patches that need to be applied to the codebase\n"
+    "6. **Security Posture**: Overall assessment of the security maturity\n\n"
+    
+    "## Output Format (use Markdown):\n"
+    "### 🚨 Executive Summary\n"
+    "- **Overall Risk Score**: X/10 (with reasoning)\n"
+    "- **Critical Issues Found**: X\n"
+    "- **Immediate Action Required**: Yes/No\n\n"
+    
+    "### 🔍 Key Findings by Category\n"
+    "#### Code Security\n"
+    "- List gitleaks, semgrep, bandit findings\n"
+    "- Highlight secrets, vulnerabilities, security hotspots\n\n"
+    
+    "#### Container Security\n"
+    "- Trivy vulnerabilities (CVEs, misconfigurations)\n"
+    "- Base image issues, outdated packages\n\n"
+    
+    "#### Kubernetes Security\n"
+    "- Kube-linter policy violations\n"
+    "- OPA compliance issues\n"
+    "- Configuration security gaps\n\n"
+    
+    "#### Runtime/Logs Analysis\n"
+    "- Security events, anomalies\n"
+    "- Attack patterns, suspicious activities\n\n"
+    
+    "### ⚡ Priority Action Items\n"
+    "| Priority | Issue | Impact | Effort | Timeline |\n"
+    "|----------|-------|--------|--------|---------|\n"
+    "| 🔴 Critical | Description | High/Medium/Low | Easy/Medium/Hard | Immediate |\n\n"
+    
+    "### 🛡️ Security Recommendations\n"
+    "1. **Immediate Actions** (0-24 hours)\n"
+    "2. **Short-term Fixes** (1-4 weeks)\n"
+    "3. **Long-term Improvements** (1-3 months)\n"
+    "4. **Process & Policy Updates**\n\n"
+    
+    "### 📊 Risk Scoring Breakdown\n"
+    "- **Secrets/Credentials Exposure**: X/3\n"
+    "- **Critical Vulnerabilities**: X/3\n"
+    "- **Configuration Issues**: X/2\n"
+    "- **Compliance Gaps**: X/2\n\n"
+    
+    "Focus on actionable insights, specific CVEs, concrete remediation steps, and business impact. "
+    "Be thorough but concise. Highlight the most critical issues that could lead to data breaches, "
+    "system compromise, or compliance violations.\n\n"
+
+    "Lastly list all filenames that have been scanned and the results of the scan in a table format (keep it short and concise)."
+    
+    "## Security Scan Data:\n```json\n"
+)
+PROMPT_DATA_LIMIT = 55000  # chars of scan JSON after the prefix
+
+
 def build_prompt(payload: Dict[str, Any]) -> str:
-    return (
-        "You are a senior cybersecurity analyst conducting a comprehensive security assessment. "
-        "Analyze the security scan results below and provide a detailed, actionable report.\n\n"
-        
-        "## Analysis Requirements:\n"
-        "1. **Risk Assessment**: Provide an overall risk score (0-10) with clear justification\n"
-        "2. **Critical Findings**: Identify the most severe vulnerabilities that need immediate attention\n"
-        "3. **Impact Analysis**: Explain potential business/security impact of key findings\n"
-        "4. **Remediation Roadmap**: Prioritized action items with timelines (immediate/short-term/long-term)\n"
-        "5. **Patching**: Provide a list of patches that need to be applied to the codebase\n"
-        "6. **Security Posture**: Overall assessment of the security maturity\n\n"
-        
-        "## Output Format (use Markdown):\n"
-        "### 🚨 Executive Summary\n"
-        "- **Overall Risk Score**: X/10 (with reasoning)\n"
-        "- **Critical Issues Found**: X\n"
-        "- **Immediate Action Required**: Yes/No\n\n"
-        
-        "### 🔍 Key Findings by Category\n"
-        "#### Code Security\n"
-        "- List gitleaks, semgrep, bandit findings\n"
-        "- Highlight secrets, vulnerabilities, security hotspots\n\n"
-        
-        "#### Container Security\n"
-        "- Trivy vulnerabilities (CVEs, misconfigurations)\n"
-        "- Base image issues, outdated packages\n\n"
-        
-        "#### Kubernetes Security\n"
-        "- Kube-linter policy violations\n"
-        "- OPA compliance issues\n"
-        "- Configuration security gaps\n\n"
-        
-        "#### Runtime/Logs Analysis\n"
-        "- Security events, anomalies\n"
-        "- Attack patterns, suspicious activities\n\n"
-        
-        "### ⚡ Priority Action Items\n"
-        "| Priority | Issue | Impact | Effort | Timeline |\n"
-        "|----------|-------|--------|--------|---------|\n"
-        "| 🔴 Critical | Description | High/Medium/Low | Easy/Medium/Hard | Immediate |\n\n"
-        
-        "### 🛡️ Security Recommendations\n"
-        "1. **Immediate Actions** (0-24 hours)\n"
-        "2. **Short-term Fixes** (1-4 weeks)\n"
-        "3. **Long-term Improvements** (1-3 months)\n"
-        "4. **Process & Policy Updates**\n\n"
-        
-        "### 📊 Risk Scoring Breakdown\n"
-        "- **Secrets/Credentials Exposure**: X/3\n"
-        "- **Critical Vulnerabilities**: X/3\n"
-        "- **Configuration Issues**: X/2\n"
-        "- **Compliance Gaps**: X/2\n\n"
-        
-        "Focus on actionable insights, specific CVEs, concrete remediation steps, and business impact. "
-        "Be thorough but concise. Highlight the most critical issues that could lead to data breaches, "
-        "system compromise, or compliance violations.\n\n"
-
-        "Lastly list all filenames that have been scanned and the results of the scan in a table format (keep it short and concise)."
-        
-        f"## Security Scan Data:\n```json\n{json.dumps(payload, ensure_ascii=False)[:55000]}\n```\n"
-    )
+    return f"{PROMPT_PREFIX}{json.dumps(payload, ensure_ascii=False)[:PROMPT_DATA_LIMIT]}\n```\n"
 
 
 @app.post("/analyze")
@@ -274,6 +305,202 @@ def analyze_stream():
     )
 
 
+class ScanSession:
+    """
+    Prompt for one scan, built while the scan runs. The scan JSON is appended section by
+    section in arrival order, so every intermediate prompt is a prefix of the final one and
+    the upstream can prefill it early. Generation starts once every expected section is in
+    (or finish() is called); its events are kept so a late stream still sees all of them.
+    """
+
+    def __init__(self, meta: Dict[str, Any], sections: List[str]):
+        self.id = str(uuid.uuid4())
+        self.expected = list(sections)
+        self.received: List[str] = []
+        # {"scan": meta, "results": {section: data, ...}} without the closing braces
+        self.data = '{"scan": %s, "results": {' % json.dumps(meta, ensure_ascii=False)
+        self.events: List[Tuple[str, Any]] = []
+        self.generating = False
+        self.closed = False
+        self.created_at = time.time()
+        self.cond = threading.Condition()
+        if PREFILL_WARM:
+            threading.Thread(target=self._warm_loop, daemon=True).start()
+
+    def add(self, name: str, data: Any) -> None:
+        with self.cond:
+            if self.generating:
+                return  # too late to change the prompt
+            sep = ", " if self.received else ""
+            self.data += f"{sep}{json.dumps(name)}: {json.dumps(data, ensure_ascii=False)}"
+            self.received.append(name)
+            self.cond.notify_all()
+        if self.expected and set(self.expected) <= set(self.received):
+            self.finish()
+
+    def prompt(self, final: bool) -> str:
+        data = self.data + "}}" if final else self.data
+        return f"{PROMPT_PREFIX}{data[:PROMPT_DATA_LIMIT]}" + ("\n```\n" if final else "")
+
+    def finish(self) -> None:
+        with self.cond:
+            if self.generating:
+                return
+            self.generating = True
+            prompt = self.prompt(final=True)
+            self.cond.notify_all()
+        threading.Thread(target=self._generate, args=(prompt,), daemon=True).start()
+
+    def close(self) -> None:
+        """Stop warming and generating; called when the session is deleted or expires."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def expired(self, now: float) -> bool:
+        return now - self.created_at > SESSION_TTL
+
+    def _warm_loop(self) -> None:
+        warmed = None
+        while True:
+            with self.cond:
+                while not (self.generating or self.closed) and self.prompt(final=False) == warmed:
+                    self.cond.wait(timeout=30)
+                    if self.expired(time.time()):
+                        return  # abandoned without DELETE and not purged yet
+                if self.generating or self.closed:
+                    return
+                warmed = self.prompt(final=False)
+            try:
+                warm_prefix(warmed, LLM_MODEL)
+            except Exception:
+                pass  # warming is only an optimization
+
+    def _push(self, kind: str, data: Any) -> None:
+        with self.cond:
+            self.events.append((kind, data))
+            self.cond.notify_all()
+
+    def _generate(self, prompt: str) -> None:
+        try:
+            acc = []
+            for piece in stream_generate(prompt, model=LLM_MODEL, temperature=0.2):
+                if self.closed:
+                    return
+                acc.append(piece)
+                self._push("delta", piece)
+            self._push("done", "".join(acc))
+        except Exception as e:
+            self._push("error", str(e))
+
+    def wait_events(self, start: int, timeout: float) -> List[Tuple[str, Any]]:
+        with self.cond:
+            if len(self.events) <= start:
+                self.cond.wait(timeout)
+            return self.events[start:]
+
+
+SESSIONS: Dict[str, ScanSession] = {}
+_sessions_lock = threading.Lock()
+
+
+def _session(session_id: str) -> Optional[ScanSession]:
+    with _sessions_lock:
+        return SESSIONS.get(session_id)
+
+
+@app.post("/sessions")
+def open_session():
+    """
+    POST JSON: { "meta": {...scan metadata...}, "sections": ["gitleaks", "semgrep", ...] }
+    Opens a scan session and starts prefilling the fixed prompt prefix upstream.
+    Sections are then added with POST /sessions/<id>/sections as the scan produces them.
+    """
+    data = request.get_json(silent=True) or {}
+    sections = data.get("sections") or []
+    if not isinstance(sections, list) or not all(isinstance(x, str) for x in sections):
+        return jsonify({"error": "sections must be a list of names"}), 400
+    now = time.time()
+    with _sessions_lock:
+        for sid in [sid for sid, s in SESSIONS.items() if s.expired(now)]:
+            SESSIONS.pop(sid).close()
+        s = ScanSession(data.get("meta") or {}, sections)
+        SESSIONS[s.id] = s
+    return jsonify({"session_id": s.id}), 201
+
+
+@app.post("/sessions/<session_id>/sections")
+def add_section(session_id):
+    """
+    POST JSON: { "name": "semgrep", "data": {...compact findings...} }
+    Appends one section; generation starts as soon as the last expected section arrives.
+    """
+    s = _session(session_id)
+    if s is None:
+        return jsonify({"error": "unknown session"}), 404
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get("name"), str):
+        return jsonify({"error": "name is required"}), 400
+    s.add(data["name"], data.get("data"))
+    return jsonify({"received": s.received, "generating": s.generating})
+
+
+@app.get("/sessions/<session_id>/stream")
+def session_stream(session_id):
+    """
+    The session's analysis in the same event format as /analyze/stream. Asking for the stream
+    means no more sections will come, so generation is started if it has not been already.
+    """
+    s = _session(session_id)
+    if s is None:
+        return jsonify({"error": "unknown session"}), 404
+    s.finish()
+
+    def event_stream():
+        yield "event: start\ndata: {}\n\n"
+        seen = 0
+        while True:
+            events = s.wait_events(seen, timeout=10)
+            if not events and s.closed:
+                yield f"event: error\ndata: {json.dumps({'error': 'session closed'})}\n\n"
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            seen += len(events)
+            for kind, data in events:
+                if kind == "delta":
+                    yield f"data: {json.dumps({'delta': data})}\n\n"
+                elif kind == "done":
+                    yield f"event: done\ndata: {json.dumps({'final': data})}\n\n"
+                else:
+                    yield f"event: error\ndata: {json.dumps({'error': data})}\n\n"
+                if kind != "delta":
+                    with _sessions_lock:
+                        SESSIONS.pop(session_id, None)
+                    s.close()
+                    return
+
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype="text/event-stream, charset=utf-8",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Connection": "keep-alive",
+        },
+    )
+
+
+@app.delete("/sessions/<session_id>")
+def close_session(session_id):
+    with _sessions_lock:
+        s = SESSIONS.pop(session_id, None)
+    if s is not None:
+        s.close()
+    return "", 204
+
+
 @app.get("/healthz")
 def healthz():
     return "ok", 200
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# agentlib, and the LLM service (run from its own directory: `from util import ...`)
+for path in (ROOT / "common", ROOT / "llm"):
+    sys.path.insert(0, str(path))
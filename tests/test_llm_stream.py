@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def _events(body: str):
+    """(event, data) pairs of an SSE body; comments (keep-alives) skipped."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        kind, data = "message", None
+        for line in block.splitlines():
+            if line.startswith("event: "):
+                kind = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        if data is not None:
+            events.append((kind, data))
+    return events
+
+
+def test_analyze_stream_relays_deltas(client, monkeypatch):
+    monkeypatch.setattr(server, "stream_generate", lambda prompt, model, temperature: iter(["Risk: ", "low"]))
+    resp = client.post("/analyze/stream", json={"findings": {}})
+    assert resp.status_code == 200
+    assert resp.mimetype.startswith("text/event-stream")
+    assert _events(resp.get_data(as_text=True)) == [
+        ("start", {}),
+        ("message", {"delta": "Risk: "}),
+        ("message", {"delta": "low"}),
+        ("done", {"final": "Risk: low"}),
+    ]
+
+
+def test_analyze_stream_reports_upstream_errors(client, monkeypatch):
+    def failing(prompt, model, temperature):
+        yield "partial"
+        raise RuntimeError("upstream went away")
+
+    monkeypatch.setattr(server, "stream_generate", failing)
+    resp = client.post("/analyze/stream", json={})
+    assert _events(resp.get_data(as_text=True))[-2:] == [
+        ("message", {"delta": "partial"}),
+        ("error", {"error": "upstream went away"}),
+    ]
+
+
+def test_analyze_stream_stops_upstream_on_disconnect(client, monkeypatch):
+    closed = []
+
+    def endless(prompt, model, temperature):
+        try:
+            while True:
+                yield "x"
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(server, "stream_generate", endless)
+    resp = client.post("/analyze/stream", json={}, buffered=False)
+    chunks = iter(resp.response)
+    assert next(chunks).startswith(b"event: start")
+    assert next(chunks) == b'data: {"delta": "x"}\n\n'
+    resp.close()  # what the WSGI server does when the client goes away
+    assert closed == [True]
@@ -0,0 +1,44 @@
+import sys
+
+import pytest
+
+from agentlib import procs
+
+
+def _python(code: str):
+    return [sys.executable, "-c", code]
+
+
+@pytest.fixture(params=["ijson", "eof"])
+def parser(request, monkeypatch):
+    """Run each test with incremental parsing and with the parse-at-EOF fallback."""
+    if request.param == "ijson":
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(procs, "ijson", None)
+    return request.param
+
+
+def test_run_json_tool_parses_reports_larger_than_a_pipe_chunk(parser):
+    # ~400 KiB: several pipe reads, well past the 64 KiB kept for error reports
+    code = ("import json; print(json.dumps({'results': "
+            "[{'id': i, 'msg': 'x' * 64} for i in range(5000)]}))")
+    rc, out = procs.run_json_tool(_python(code))
+    assert rc == 0
+    assert [r["id"] for r in out["results"]] == list(range(5000))
+
+
+def test_run_json_tool_returns_raw_output_that_is_not_json(parser):
+    rc, out = procs.run_json_tool(_python("import sys; print('no report'); sys.stderr.write('boom\\n'); sys.exit(2)"))
+    assert rc == 2
+    assert out == {"raw": "no report", "stderr": "boom"}
+
+
+def test_run_json_tool_keeps_the_head_of_large_non_json_output(parser):
+    rc, out = procs.run_json_tool(_python("print('y' * (200 * 1024))"))
+    assert rc == 0
+    assert out["raw"].startswith("y" * 1024)
+
+
+def test_run_json_tool_treats_empty_output_as_empty_report(parser):
+    assert procs.run_json_tool(_python("pass")) == (0, {})
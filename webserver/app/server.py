@@ -62,6 +62,52 @@ def logs_findings():
     r = requests.get(f"{SYS_URL}/findings", timeout=30)
     return (r.text, r.status_code, {"Content-Type": r.headers.get("Content-Type", "application/json")})
 
+def _iter_sse(response):
+    """Yield (event, data) pairs from a streaming text/event-stream response; comments come as (':', text)."""
+    event_type, data_lines = 'message', []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data_lines:
+                yield event_type, '\n'.join(data_lines)
+            event_type, data_lines = 'message', []
+        elif line.startswith(':'):
+            yield ':', line[1:].strip()
+        elif line.startswith('event:'):
+            event_type = line[6:].strip()
+        elif line.startswith('data:'):
+            data_lines.append(line[5:].strip())
+
+def _open_llm_session(meta, sections):
+    """Open an LLM scan session so prompt prefill overlaps the scan; None if the LLM service declines."""
+    try:
+        r = requests.post(f"{LLM_URL.rstrip('/')}/sessions", json={"meta": meta, "sections": sections}, timeout=10)
+        return r.json()["session_id"] if r.ok else None
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+
+def _add_llm_section(session_id, name, data):
+    """Append one section to the session's prompt; False if it could not be delivered."""
+    try:
+        r = requests.post(f"{LLM_URL.rstrip('/')}/sessions/{session_id}/sections", json={"name": name, "data": data}, timeout=10)
+        return r.ok
+    except requests.RequestException:
+        return False
+
+def _close_llm_session(session_id):
+    if session_id:
+        try:
+            requests.delete(f"{LLM_URL.rstrip('/')}/sessions/{session_id}", timeout=5)
+        except requests.RequestException:
+            pass
+
+def _llm_analysis(session_id, scan_results):
+    """Streaming analysis: the session's generation (usually already running) or a fresh /analyze/stream."""
+    if session_id:
+        return requests.get(f"{LLM_URL.rstrip('/')}/sessions/{session_id}/stream", stream=True)
+    return requests.post(f"{LLM_URL.rstrip('/')}/analyze/stream", json=scan_results, stream=True)
+
 # Streaming LLM analysis endpoints
 @app.post("/scan/code/stream")
 def scan_code_stream():
@@ -70,17 +116,39 @@ def scan_code_stream():
     def event_stream():
         yield "event: start\ndata: {}\n\n"
         last_beat = time.time()
+        session_id = None
         
         try:
             # Step 1: Call code agent to perform actual security scan
             yield f"data: {json.dumps({'status': 'Cloning repository and running security scans...'})}\n\n"
             
-            scan_response = requests.post(f"{CODE_URL}/scan", json=payload)
+            scan_response = requests.post(f"{CODE_URL}/scan/stream", json={**payload, 'raw': False}, stream=True)
             if not scan_response.ok:
                 yield f"event: error\ndata: {json.dumps({'error': f'Code agent scan failed: HTTP {scan_response.status_code}'})}\n\n"
                 return
             
-            scan_results = scan_response.json()
+            # Tool results arrive one by one as each scanner finishes; only the
+            # compact normalized findings are requested, they are all the LLM needs
+            # The LLM session gets each tool's findings as they arrive and starts generating
+            # when the last one is in, so prefill overlaps the remaining scanners
+            scan_results = {}
+            for event_type, event_data in _iter_sse(scan_response):
+                if event_type == 'start':
+                    meta = json.loads(event_data)
+                    session_id = _open_llm_session({k: v for k, v in meta.items() if k != 'tools'}, meta.get('tools') or [])
+                elif event_type == 'result':
+                    result = json.loads(event_data)
+                    if session_id and not _add_llm_section(session_id, result['tool'], {
+                            'exit_code': result['exit_code'], 'normalized': result.get('normalized')}):
+                        _close_llm_session(session_id)
+                        session_id = None  # fall back to /analyze/stream with the final results
+                    status = f"{result['tool']} finished (exit {result['exit_code']}), waiting for remaining scanners..."
+                    yield f"data: {json.dumps({'status': status})}\n\n"
+                elif event_type == 'done':
+                    scan_results = json.loads(event_data)
+                if time.time() - last_beat > 10:
+                    yield ": keep-alive\n\n"
+                    last_beat = time.time()
             
             # Wait for confirmation that all scanning is complete
             if scan_results.get('message') != 'ok':
@@ -89,12 +157,8 @@ def scan_code_stream():
                 
             yield f"data: {json.dumps({'status': 'Security scan completed, starting AI analysis...'})}\n\n"
             
-            # Step 2: Send scan results to LLM for streaming analysis
-            llm_response = requests.post(
-                f"{LLM_URL.rstrip('/')}/analyze/stream", 
-                json=scan_results, 
-                stream=True
-            )
+            # Step 2: Stream the LLM analysis (already generating when a session was used)
+            llm_response = _llm_analysis(session_id, scan_results)
             
             if not llm_response.ok:
                 yield f"event: error\ndata: {json.dumps({'error': f'LLM service error: HTTP {llm_response.status_code}'})}\n\n"
@@ -129,6 +193,9 @@ def scan_code_stream():
             yield f"event: error\ndata: {json.dumps({'error': f'Request failed: {str(e)}'})}\n\n"
         except Exception as e:
             yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # no-op once the stream finished (the LLM service drops the session itself)
+            _close_llm_session(session_id)
     
     return Response(
         stream_with_context(event_stream()),
@@ -147,12 +214,15 @@ def scan_container_stream():
     def event_stream():
         yield "event: start\ndata: {}\n\n"
         last_beat = time.time()
+        session_id = None
         
         try:
             # Step 1: Call container agent to perform actual security scan
             yield f"data: {json.dumps({'status': 'Cloning repository and running container security scans...'})}\n\n"
             
-            scan_response = requests.post(f"{CONT_URL}/scan", json=payload)
+            # Prefill the prompt prefix while the agent clones and scans
+            session_id = _open_llm_session({'repo': payload.get('repo'), 'ref': payload.get('ref')}, ['container'])
+            scan_response = requests.post(f"{CONT_URL}/scan", json={**payload, 'raw': False})
             if not scan_response.ok:
                 yield f"event: error\ndata: {json.dumps({'error': f'Container agent scan failed: HTTP {scan_response.status_code}'})}\n\n"
                 return
@@ -166,12 +236,11 @@ def scan_container_stream():
                 
             yield f"data: {json.dumps({'status': 'Container security scan completed, starting AI analysis...'})}\n\n"
             
-            # Step 2: Send scan results to LLM for streaming analysis
-            llm_response = requests.post(
-                f"{LLM_URL.rstrip('/')}/analyze/stream", 
-                json=scan_results, 
-                stream=True
-            )
+            # Step 2: Stream the LLM analysis; adding the last section starts generation
+            if session_id and not _add_llm_section(session_id, 'container', scan_results):
+                _close_llm_session(session_id)
+                session_id = None
+            llm_response = _llm_analysis(session_id, scan_results)
             
             if not llm_response.ok:
                 yield f"event: error\ndata: {json.dumps({'error': f'LLM service error: HTTP {llm_response.status_code}'})}\n\n"
@@ -206,6 +275,9 @@ def scan_container_stream():
             yield f"event: error\ndata: {json.dumps({'error': f'Request failed: {str(e)}'})}\n\n"
         except Exception as e:
             yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # no-op once the stream finished (the LLM service drops the session itself)
+            _close_llm_session(session_id)
     
     return Response(
         stream_with_context(event_stream()),
@@ -224,12 +296,15 @@ def scan_k8s_stream():
     def event_stream():
         yield "event: start\ndata: {}\n\n"
         last_beat = time.time()
+        session_id = None
         
         try:
             # Step 1: Call k8s agent to perform actual security scan
             yield f"data: {json.dumps({'status': 'Cloning repository and running K8s security analysis...'})}\n\n"
             
-            scan_response = requests.post(f"{K8S_URL}/scan", json=payload)
+            # Prefill the prompt prefix while the agent clones and scans
+            session_id = _open_llm_session({'repo': payload.get('repo'), 'ref': payload.get('ref')}, ['k8s'])
+            scan_response = requests.post(f"{K8S_URL}/scan", json={**payload, 'raw': False})
             if not scan_response.ok:
                 yield f"event: error\ndata: {json.dumps({'error': f'K8s agent scan failed: HTTP {scan_response.status_code}'})}\n\n"
                 return
@@ -243,12 +318,11 @@ def scan_k8s_stream():
                 
             yield f"data: {json.dumps({'status': 'K8s security analysis completed, starting AI analysis...'})}\n\n"
             
-            # Step 2: Send scan results to LLM for streaming analysis
-            llm_response = requests.post(
-                f"{LLM_URL.rstrip('/')}/analyze/stream", 
-                json=scan_results, 
-                stream=True
-            )
+            # Step 2: Stream the LLM analysis; adding the last section starts generation
+            if session_id and not _add_llm_section(session_id, 'k8s', scan_results):
+                _close_llm_session(session_id)
+                session_id = None
+            llm_response = _llm_analysis(session_id, scan_results)
             
             if not llm_response.ok:
                 yield f"event: error\ndata: {json.dumps({'error': f'LLM service error: HTTP {llm_response.status_code}'})}\n\n"
@@ -283,6 +357,9 @@ def scan_k8s_stream():
             yield f"event: error\ndata: {json.dumps({'error': f'Request failed: {str(e)}'})}\n\n"
         except Exception as e:
             yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # no-op once the stream finished (the LLM service drops the session itself)
+            _close_llm_session(session_id)
     
     return Response(
         stream_with_context(event_stream()),